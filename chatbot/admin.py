@@ -1,7 +1,64 @@
+from django import forms
 from django.contrib import admin
-from .models import Chat , UserSetting, BotSetting
+
+from .models import BotSetting, Chat, Conversation, PromptTemplate, UserSetting
+from .prompts import DEFAULT_PROMPT, DEFAULT_PROMPT_JP, intern_prompt
+
+
+class UserSettingForm(forms.ModelForm):
+    """人设以文本编辑，保存时存入 PromptTemplate 并引用其摘要；与默认人设相同或留空时不引用。"""
+    prompt = forms.CharField(widget=forms.Textarea, required=False, label='人设 prompt')
+    promptJP = forms.CharField(widget=forms.Textarea, required=False, label='人设 prompt（日语）')
+
+    class Meta:
+        model = UserSetting
+        exclude = ['prompt_template', 'prompt_jp_template']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.initial.setdefault('prompt', self.instance.prompt)
+        self.initial.setdefault('promptJP', self.instance.promptJP)
+
+    def save(self, commit=True):
+        setting = super().save(commit=False)
+        setting.prompt_template_id = self._template(self.cleaned_data['prompt'], DEFAULT_PROMPT)
+        setting.prompt_jp_template_id = self._template(
+            self.cleaned_data['promptJP'], DEFAULT_PROMPT_JP
+        )
+        if commit:
+            setting.save()
+            self.save_m2m()
+        return setting
+
+    @staticmethod
+    def _template(text, default):
+        text = text.replace('\r\n', '\n')
+        return intern_prompt(text) if text.strip() and text != default else None
+
+
+class UserSettingAdmin(admin.ModelAdmin):
+    form = UserSettingForm
+
+
+class PromptTemplateAdmin(admin.ModelAdmin):
+    """摘要由内容计算，创建后内容只读，已被引用的摘要始终指向同一段文本。"""
+    list_display = ['digest', '__str__', 'created_at']
+    search_fields = ['digest', 'content']
+
+    def get_readonly_fields(self, request, obj=None):
+        return ['digest', 'content', 'created_at'] if obj else ['digest', 'created_at']
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            return
+        # 相同文本已存在时直接复用该行
+        obj.digest = intern_prompt(obj.content.replace('\r\n', '\n'))
+        obj.refresh_from_db()
+
 
 # Register your models here.
 admin.site.register(Chat)
-admin.site.register(UserSetting)
-admin.site.register(BotSetting)
\ No newline at end of file
+admin.site.register(UserSetting, UserSettingAdmin)
+admin.site.register(BotSetting)
+admin.site.register(Conversation)
+admin.site.register(PromptTemplate, PromptTemplateAdmin)
@@ -0,0 +1,200 @@
+"""上游补全请求的准入控制。
+
+同时进行的补全数受三层限制：全局上限、每个用户的上限，以及按 Key 来源划分的池
+（使用站点共享 ``BotSetting.apikey`` 的用户与自带 ``user_api_key`` 的用户互不占用名额）。
+超出限制的请求排队等待，按加权公平排队（start-time fair queuing）调度：
+每个请求按用户分配虚拟开始/完成标记，同一用户连续提交的请求标记依次后移，
+因此突发大量请求的用户不会挤占偶尔发一条消息的用户，后者的尾延迟基本不受影响。
+
+排队中的请求可通过 ``on_position`` 回调得知自己当前的排队位置（从 1 开始）。
+"""
+
+import asyncio
+import bisect
+import itertools
+import threading
+from collections import Counter
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+SHARED_POOL = 'shared'
+OWN_KEY_POOL = 'own'
+
+
+class AdmissionTimeout(Exception):
+    """排队超过 ADMISSION_QUEUE_TIMEOUT 仍未获得名额。"""
+
+
+class _Waiter:
+    __slots__ = (
+        'user_id', 'pool', 'start', 'tag', 'seq', 'loop', 'event',
+        'admitted', 'position', 'released',
+    )
+
+    def __init__(self, user_id, pool, loop):
+        self.user_id = user_id
+        self.pool = pool
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.admitted = False
+        self.released = False
+        self.position = 0
+        self.start = self.tag = 0.0
+        self.seq = 0
+
+    def __lt__(self, other):
+        return (self.tag, self.seq) < (other.tag, other.seq)
+
+
+def admission_pool(turn) -> str:
+    """回合使用的 Key 来源：用户自带 Key 走独立的池。"""
+    return OWN_KEY_POOL if turn.user_setting.user_api_key else SHARED_POOL
+
+
+class AdmissionController:
+    """线程安全的准入控制器；等待方须运行在事件循环内。"""
+
+    def __init__(self, global_limit=None, per_user_limit=None, pool_limits=None, weights=None):
+        self.global_limit = global_limit or getattr(settings, 'ADMISSION_GLOBAL_LIMIT', 32)
+        self.per_user_limit = per_user_limit or getattr(settings, 'ADMISSION_PER_USER_LIMIT', 2)
+        self.pool_limits = pool_limits or {
+            SHARED_POOL: getattr(settings, 'ADMISSION_SHARED_LIMIT', 16),
+            OWN_KEY_POOL: getattr(settings, 'ADMISSION_OWN_KEY_LIMIT', 16),
+        }
+        self.weights = weights or {}  # pool -> 权重，默认 1
+        self._lock = threading.Lock()
+        self._active = 0
+        self._active_by_user = Counter()
+        self._active_by_pool = Counter()
+        self._waiting = []  # 按 (tag, seq) 排序
+        self._finish = {}  # user_id -> 该用户最近一个请求的虚拟完成标记
+        self._vtime = 0.0
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.timeouts = 0
+
+    @asynccontextmanager
+    async def slot(self, user_id, pool=SHARED_POOL, on_position=None, timeout=None):
+        waiter = await self.acquire(user_id, pool, on_position=on_position, timeout=timeout)
+        try:
+            yield waiter
+        finally:
+            self.release(waiter)
+
+    async def acquire(self, user_id, pool=SHARED_POOL, on_position=None, timeout=None):
+        """获得一个名额后返回凭据，用完须调用 release。"""
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(user_id, pool, loop)
+        with self._lock:
+            start = max(self._vtime, self._finish.get(user_id, 0.0))
+            waiter.start = start
+            waiter.tag = self._finish[user_id] = start + 1.0 / self.weights.get(pool, 1)
+            waiter.seq = next(self._seq)
+            bisect.insort(self._waiting, waiter)
+            wake = self._dispatch()
+        self._wake(wake)
+        if waiter.admitted:
+            return waiter
+
+        self.queued += 1
+        if timeout is None:
+            timeout = getattr(settings, 'ADMISSION_QUEUE_TIMEOUT', 60)
+        deadline = loop.time() + timeout
+        reported = 0
+        try:
+            while True:
+                waiter.event.clear()
+                if waiter.admitted:
+                    return waiter
+                if on_position is not None and waiter.position != reported:
+                    reported = waiter.position
+                    await on_position(reported)
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise AdmissionTimeout()
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # 超时或任务被取消：退出队列；若恰好已获得名额则归还
+            with self._lock:
+                if waiter.admitted:
+                    self._finish_locked(waiter)
+                else:
+                    self._waiting.remove(waiter)
+                wake = self._dispatch()
+            self._wake(wake)
+            raise
+
+    def release(self, waiter):
+        with self._lock:
+            if waiter.released:
+                return
+            self._finish_locked(waiter)
+            wake = self._dispatch()
+        self._wake(wake)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': self._active,
+                'waiting': len(self._waiting),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'timeouts': self.timeouts,
+            }
+
+    def _can_run(self, waiter):
+        pool_limit = self.pool_limits.get(waiter.pool, self.global_limit)
+        return (
+            self._active < self.global_limit
+            and self._active_by_pool[waiter.pool] < pool_limit
+            and self._active_by_user[waiter.user_id] < self.per_user_limit
+        )
+
+    def _dispatch(self):
+        """按标记顺序放行所有能运行的等待者，返回需要唤醒的等待者。"""
+        wake = []
+        remaining = []
+        for waiter in self._waiting:
+            if self._can_run(waiter):
+                waiter.admitted = True
+                self._active += 1
+                self._active_by_user[waiter.user_id] += 1
+                self._active_by_pool[waiter.pool] += 1
+                self._vtime = max(self._vtime, waiter.start)
+                self.admitted += 1
+                wake.append(waiter)
+            else:
+                remaining.append(waiter)
+        self._waiting = remaining
+        for position, waiter in enumerate(remaining, 1):
+            if waiter.position != position:
+                waiter.position = position
+                wake.append(waiter)
+        return wake
+
+    def _finish_locked(self, waiter):
+        waiter.released = True
+        self._active -= 1
+        self._active_by_user[waiter.user_id] -= 1
+        self._active_by_pool[waiter.pool] -= 1
+        if not self._active_by_user[waiter.user_id]:
+            del self._active_by_user[waiter.user_id]
+            # 用户已无进行中与排队的请求，其标记不再需要保留
+            if not any(w.user_id == waiter.user_id for w in self._waiting):
+                self._finish.pop(waiter.user_id, None)
+
+    @staticmethod
+    def _wake(waiters):
+        for waiter in waiters:
+            if not waiter.loop.is_closed():
+                waiter.loop.call_soon_threadsafe(waiter.event.set)
+
+
+admission = AdmissionController()
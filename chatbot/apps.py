@@ -1,6 +1,22 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db.backends.signals import connection_created
 
 
 class ChatbotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatbot'
+
+    def ready(self):
+        from .db_connections import close_request_connections
+        from .metrics import install_query_counter
+        from .retrieval import load_index, retrieval_enabled
+        if getattr(settings, 'METRICS_ENABLED', False):
+            # 按阶段统计数据库查询数，见 metrics.query_phase
+            connection_created.connect(install_query_counter)
+        if retrieval_enabled():
+            # 每个进程启动时建立一次 wiki 索引，回合中不再读文件
+            load_index()
+        # ASGI 请求的临时线程结束前关闭其上的数据库连接，见 db_connections
+        request_finished.connect(close_request_connections)
@@ -0,0 +1,99 @@
+"""带 psycopg_pool 连接池的 PostgreSQL 后端（可选，需要 ``pip install .[postgres]``）。
+
+Django 4.2 的 PostgreSQL 后端每次 ``connect()`` 都新建 TCP 连接；这里改为从进程内的
+``ConnectionPool`` 借出，``close()`` 时归还，``CONN_MAX_AGE`` 应保持为 0（settings 中自动处理）。
+池参数取自 ``OPTIONS['pool']``，原样传给 ``ConnectionPool``（``min_size``、``max_size`` 等）；
+``CONN_HEALTH_CHECKS=True`` 时借出前检查连接是否可用。
+
+池按 (别名, 库名, 主机, 端口, 用户) 区分，测试时切换到测试库会使用新的池；
+删除测试库前关闭指向它的池。Django 5.1 起原生支持 ``OPTIONS['pool']``，升级后可换回原生后端。
+"""
+
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.postgresql import base, creation
+from django.db.utils import NO_DB_ALIAS
+
+try:
+    from psycopg import IsolationLevel
+    from psycopg_pool import ConnectionPool
+except ImportError as e:  # pragma: no cover - 取决于是否安装了可选依赖
+    raise ImproperlyConfigured(
+        'chatbot.backends.postgresql_pool requires psycopg>=3.1 and psycopg-pool>=3.2'
+    ) from e
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def close_pools(name=None):
+    """关闭全部连接池，或只关闭指向库 name 的池。"""
+    with _pools_lock:
+        keys = [key for key in _pools if name is None or key[1] == name]
+        pools = [_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.close()
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # 池中空闲的连接仍连着测试库，不关闭的话 DROP DATABASE 会失败
+        close_pools(test_database_name)
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.pool_options = params.pop('pool', {})
+        return params
+
+    def _pool(self, conn_params):
+        s = self.settings_dict
+        key = (self.alias, s['NAME'], s['HOST'], s['PORT'], s['USER'])
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                check = ConnectionPool.check_connection if s['CONN_HEALTH_CHECKS'] else None
+                pool = _pools[key] = ConnectionPool(
+                    # 以 autocommit 借出，随后由 Django 按需设置
+                    kwargs={**conn_params, 'autocommit': True},
+                    check=check,
+                    name=f'django-{self.alias}',
+                    open=True,
+                    **self.pool_options,
+                )
+        return pool
+
+    def get_new_connection(self, conn_params):
+        if self.alias == NO_DB_ALIAS:
+            # 创建/删除测试库等维护连接不进池
+            return super().get_new_connection(conn_params)
+        isolation_level = self.settings_dict['OPTIONS'].get('isolation_level')
+        try:
+            self.isolation_level = IsolationLevel(
+                IsolationLevel.READ_COMMITTED if isolation_level is None else isolation_level
+            )
+        except ValueError:
+            raise ImproperlyConfigured(
+                f'Invalid transaction isolation level {isolation_level} specified. '
+                f'Use one of the psycopg.IsolationLevel values.'
+            )
+        connection = self._pool(conn_params).getconn()
+        if isolation_level is not None:
+            connection.isolation_level = self.isolation_level
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        with self.wrap_database_errors:
+            pool = getattr(self.connection, '_pool', None)
+            if pool is None:
+                self.connection.close()
+            else:
+                # 归还时池会回滚未结束的事务并在后台检查连接状态
+                pool.putconn(self.connection)
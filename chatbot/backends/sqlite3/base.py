@@ -0,0 +1,42 @@
+"""在 Django 自带 SQLite 后端上增加每个连接的 PRAGMA 与写事务模式。
+
+``DATABASES['default']['OPTIONS']`` 中额外识别两个键（其余照常传给 ``sqlite3.connect``）：
+
+- ``pragmas``：``{名称: 值}``，每个新连接建立后依次执行 ``PRAGMA 名称 = 值``；
+- ``transaction_mode``：``DEFERRED``（默认，与原生后端一致）/ ``IMMEDIATE`` / ``EXCLUSIVE``，
+  决定 ``transaction.atomic()`` 开启事务时使用的 ``BEGIN`` 语句。
+
+WAL 下读写可以并发，但 ``DEFERRED`` 事务先读后写时需要把读锁升级为写锁，
+若此时另一连接已持有写锁，SQLite 会直接返回 “database is locked” 而不等待 ``busy_timeout``。
+``IMMEDIATE`` 在事务开始时就取得写锁，冲突的写事务在 ``BEGIN`` 处按 ``timeout`` 排队。
+（Django 5.1 起原生支持 ``transaction_mode`` 与 ``init_command``，升级后可换回原生后端。）
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = {'DEFERRED', 'IMMEDIATE', 'EXCLUSIVE'}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    pragmas = {}
+    transaction_mode = 'DEFERRED'
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.pragmas = kwargs.pop('pragmas', {})
+        mode = kwargs.pop('transaction_mode', 'DEFERRED').upper()
+        if mode not in TRANSACTION_MODES:
+            choices = ', '.join(sorted(TRANSACTION_MODES))
+            raise ImproperlyConfigured(f'transaction_mode must be one of {choices}, got {mode!r}')
+        self.transaction_mode = mode
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f'BEGIN {self.transaction_mode}')
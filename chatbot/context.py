@@ -0,0 +1,100 @@
+"""Prompt 上下文构造：按 token 预算截取会话中最新的消息。
+
+会话的人设 prompt 不在消息表中，由调用方传入 persona 前置为第一条 system 消息，
+不占用消息的 token 预算，长会话也不会把人设挤出上下文。
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, RowRange, Sum, Window
+
+from .context_cache import cache_enabled, context_cache
+from .conversations import counts_toward_summary
+from .models import Conversation, Message
+
+
+def _token_limit():
+    return getattr(settings, 'TOKEN_CONTEXT_LIMIT', 3000)
+
+
+def _context_rows(user, conversation_id, token_limit):
+    running_tokens = Window(
+        Sum('tokens'),
+        order_by=[F('created_at').desc(), F('id').desc()],
+        frame=RowRange(start=None, end=0),
+    )
+    return (
+        Message.objects.filter(user=user, conversation_id=conversation_id)
+        .annotate(running_tokens=running_tokens)
+        .filter(running_tokens__lte=token_limit)
+        .order_by('created_at', 'id')
+        .values_list('role', 'content', 'tokens')
+    )
+
+
+def _with_persona(persona, messages):
+    if persona:
+        return [{"role": "system", "content": persona}] + messages
+    return messages
+
+
+def build_context(user, conversation_id, token_limit=None, persona=None):
+    """取最新的、累计 tokens 不超过上限的消息，返回按时间升序的 messages 列表。
+
+    累计值由窗口函数在数据库内计算，只读取最终会发送的行与所需列，
+    读取量与会话历史长度无关（依赖 (user, conversation_id, created_at) 复合索引）。
+    """
+    if token_limit is None:
+        token_limit = _token_limit()
+    rows = _context_rows(user, conversation_id, token_limit)
+    return _with_persona(
+        persona, [{"role": role, "content": content} for role, content, _ in rows]
+    )
+
+
+def _conversation_version(conversation_id):
+    """上下文缓存的版本；没有 Conversation 行的旧会话返回 None，不走缓存。"""
+    return (
+        Conversation.objects.filter(pk=conversation_id)
+        .values_list('latest_summary_id', 'message_count').first()
+    )
+
+
+def load_context(user, conversation_id, persona=None, pending=None):
+    """优先从进程内上下文缓存读取，未命中时查库，并在事务提交后预热缓存。
+
+    pending 为当前事务中刚写入（且已计入会话计数）的消息，缓存命中时拼接在末尾，
+    提交后再追加到缓存；调用方不必再对它调用 remember_message。
+    """
+    token_limit = _token_limit()
+    version = _conversation_version(conversation_id) if cache_enabled() else None
+    if version is not None:
+        expected = version
+        if pending is not None and counts_toward_summary(pending):
+            expected = (version[0], version[1] - 1)
+        cached = context_cache.get(
+            conversation_id, token_limit, expected,
+            pending=(pending.role, pending.content, pending.tokens) if pending else None,
+        )
+        if cached is not None:
+            if pending is not None:
+                remember_message(pending)
+            return _with_persona(persona, cached)
+    rows = list(_context_rows(user, conversation_id, token_limit))
+    if version is not None:
+        # 版本在行之前读取：两者之间有提交时缓存项版本偏旧，下次读取会被丢弃
+        transaction.on_commit(
+            lambda: context_cache.seed(conversation_id, token_limit, version, rows)
+        )
+    return _with_persona(
+        persona, [{"role": role, "content": content} for role, content, _ in rows]
+    )
+
+
+def remember_message(msg):
+    """事务提交后把消息追加到该会话的上下文缓存（未缓存的会话忽略），回滚时不追加。"""
+    if cache_enabled():
+        transaction.on_commit(lambda: context_cache.append(
+            msg.conversation_id, msg.role, msg.content, msg.tokens,
+            counted=counts_toward_summary(msg),
+        ))
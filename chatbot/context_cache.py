@@ -0,0 +1,148 @@
+"""进程内的会话上下文缓存。
+
+每个会话保存一个最近消息的 deque 与其 token 累计值，始终只保留恰好能放进
+``TOKEN_CONTEXT_LIMIT`` 的最新消息。回合内新写入的消息在事务提交后追加到缓存，
+已预热的会话构造上下文时只需按主键读取一次会话的版本。
+
+每项缓存带有版本 ``(latest_summary_id, message_count)``，取自 ``Conversation``：
+生成摘要会换掉摘要 id，漏记或重复追加消息会使计数对不上，版本与数据库不一致的
+缓存项一律丢弃并重新查库。
+
+默认关闭（``CONTEXT_CACHE_ENABLED=False``），只适用于单进程部署：其它进程写入
+的消息与失效不会同步过来，虽然版本校验能发现计数变化，但无法发现计数不变的改动。
+"""
+
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+
+class _Entry:
+    __slots__ = ('token_limit', 'version', 'messages', 'tokens', 'nbytes')
+
+    def __init__(self, token_limit, version):
+        self.token_limit = token_limit
+        self.version = version
+        self.messages = deque()  # (role, content, tokens, nbytes)
+        self.tokens = 0
+        self.nbytes = 0
+
+    def push(self, role, content, tokens):
+        nbytes = len(content.encode('utf-8'))
+        self.messages.append((role, content, tokens, nbytes))
+        self.tokens += tokens
+        self.nbytes += nbytes
+        while self.messages and self.tokens > self.token_limit:
+            _, _, old_tokens, old_bytes = self.messages.popleft()
+            self.tokens -= old_tokens
+            self.nbytes -= old_bytes
+
+
+class ContextCache:
+    """按 conversation_id 的 LRU 缓存，总内存（按内容字节粗算）有上限。"""
+
+    def __init__(self, max_conversations=None, max_bytes=None):
+        self.max_conversations = max_conversations or getattr(
+            settings, 'CONTEXT_CACHE_MAX_CONVERSATIONS', 1024
+        )
+        self.max_bytes = max_bytes or getattr(settings, 'CONTEXT_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, conversation_id, token_limit, version, pending=None):
+        """命中时返回 [{"role", "content"}, ...]，未命中返回 None。
+
+        version 与缓存项不一致时丢弃该项。pending 为尚未提交的 (role, content, tokens)，
+        只拼接到返回的上下文末尾，不写入缓存。
+        """
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None or entry.token_limit != token_limit or entry.version != version:
+                if entry is not None:
+                    self._discard(conversation_id)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(conversation_id)
+            messages = deque(entry.messages)
+            tokens = entry.tokens
+        if pending is not None:
+            view = _Entry(token_limit, version)
+            view.messages, view.tokens = messages, tokens
+            view.push(pending[0], pending[1], pending[2] or 0)
+            messages = view.messages
+        return [{"role": role, "content": content} for role, content, _, _ in messages]
+
+    def seed(self, conversation_id, token_limit, version, rows):
+        """用数据库中构造好的上下文 (role, content, tokens) 初始化一个会话。"""
+        entry = _Entry(token_limit, version)
+        for role, content, tokens in rows:
+            entry.push(role, content, tokens or 0)
+        with self._lock:
+            self._discard(conversation_id)
+            self._entries[conversation_id] = entry
+            self._nbytes += entry.nbytes
+            self._shrink()
+
+    def append(self, conversation_id, role, content, tokens, counted=True):
+        """追加已提交的消息；会话未缓存时忽略，下次读取会从数据库重建。
+
+        counted 表示该消息计入 ``Conversation.message_count``，此时版本中的计数随之加一。
+        """
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return False
+            self._nbytes -= entry.nbytes
+            entry.push(role, content, tokens or 0)
+            if counted:
+                summary_id, count = entry.version
+                entry.version = (summary_id, count + 1)
+            self._nbytes += entry.nbytes
+            self._entries.move_to_end(conversation_id)
+            self._shrink()
+            return conversation_id in self._entries
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            self._discard(conversation_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._entries),
+                'bytes': self._nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _discard(self, conversation_id):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self._nbytes -= entry.nbytes
+
+    def _shrink(self):
+        while self._entries and (
+            len(self._entries) > self.max_conversations or self._nbytes > self.max_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self._nbytes -= entry.nbytes
+            self.evictions += 1
+
+
+context_cache = ContextCache()
+
+
+def cache_enabled() -> bool:
+    return getattr(settings, 'CONTEXT_CACHE_ENABLED', False)
@@ -0,0 +1,112 @@
+"""会话定位与会话元数据维护。
+
+``UserSetting.active_conversation`` 指向当前会话，回合开始时按主键直接取得，
+不再扫描用户最早的 system 消息。``Conversation`` 上的计数随消息写入以 ``F()``
+原子更新，摘要阈值判断读取计数即可，无需对消息表做 COUNT。
+"""
+
+from django.db.models import Count, F, Max, Q, Sum
+
+from .models import Conversation, Message, UserSetting
+from .prompts import intern_prompt, prompt_text
+
+
+def counts_toward_summary(message) -> bool:
+    return message.role in ('user', 'assistant') and not message.is_summary
+
+
+def start_conversation(user, user_setting):
+    """新建会话并设为用户的当前会话；人设 prompt 以 PromptTemplate 引用，不写入消息表。"""
+    conversation = Conversation.objects.create(
+        user=user, prompt_template_id=intern_prompt(user_setting.prompt)
+    )
+    activate(user_setting, conversation)
+    return conversation.pk
+
+
+def conversation_prompt_digest(conversation_id):
+    """会话人设的 PromptTemplate 摘要；旧会话的人设仍是消息表中的 system 消息，此时返回 None。"""
+    return (
+        Conversation.objects.filter(pk=conversation_id)
+        .values_list('prompt_template_id', flat=True).first()
+    )
+
+
+def conversation_persona(conversation_id):
+    """会话的人设文本；旧会话返回 None。"""
+    digest = conversation_prompt_digest(conversation_id)
+    return prompt_text(digest) if digest else None
+
+
+def activate(user_setting, conversation):
+    Conversation.objects.filter(user_id=user_setting.user_id, is_active=True).exclude(
+        pk=conversation.pk
+    ).update(is_active=False)
+    # 只写这一列，避免覆盖并发写入的额度计数
+    UserSetting.objects.filter(pk=user_setting.pk).update(active_conversation=conversation)
+    user_setting.active_conversation = conversation
+
+
+def active_conversation_id(user, user_setting):
+    """当前会话的 id；没有时沿用旧数据中最早的 system 消息所在会话，再没有则新建。"""
+    if user_setting.active_conversation_id:
+        return user_setting.active_conversation_id
+    first_system = (
+        Message.objects.filter(user=user, role='system').order_by('created_at').first()
+    )
+    if first_system is None:
+        return start_conversation(user, user_setting)
+    conversation = adopt(user, first_system.conversation_id)
+    activate(user_setting, conversation)
+    return conversation.pk
+
+
+def adopt(user, conversation_id):
+    """为尚无 Conversation 行的旧会话建立元数据。"""
+    conversation, created = Conversation.objects.get_or_create(pk=conversation_id, user=user)
+    if created:
+        refresh_stats(conversation_id)
+        conversation.refresh_from_db()
+    return conversation
+
+
+def record_message(message):
+    """消息写入后同步更新所属会话的计数，须与写入在同一事务内调用。"""
+    updates = {
+        'token_total': F('token_total') + (message.tokens or 0),
+        'last_message_at': message.created_at,
+    }
+    if counts_toward_summary(message):
+        updates['message_count'] = F('message_count') + 1
+    Conversation.objects.filter(pk=message.conversation_id).update(**updates)
+    return message
+
+
+def refresh_stats(conversation_id, latest_summary=None):
+    """按消息表重新计算会话计数；批量删除消息（如生成摘要）后调用。"""
+    stats = Message.objects.filter(conversation_id=conversation_id).aggregate(
+        message_count=Count(
+            'id', filter=Q(role__in=['user', 'assistant'], is_summary=False)
+        ),
+        token_total=Sum('tokens'),
+        last_message_at=Max('created_at'),
+    )
+    stats['token_total'] = stats['token_total'] or 0
+    if latest_summary is not None:
+        stats['latest_summary'] = latest_summary
+    Conversation.objects.filter(pk=conversation_id).update(**stats)
+
+
+def unsummarized_count(user_id, conversation_id) -> int:
+    """会话中未被摘要的 user/assistant 消息条数，读取计数而非统计消息表。"""
+    count = (
+        Conversation.objects.filter(pk=conversation_id, user_id=user_id)
+        .values_list('message_count', flat=True).first()
+    )
+    if count is None:
+        # 没有元数据的旧会话
+        count = Message.objects.filter(
+            user_id=user_id, conversation_id=conversation_id,
+            role__in=['user', 'assistant'], is_summary=False,
+        ).count()
+    return count
@@ -0,0 +1,30 @@
+"""数据库持久连接（``CONN_MAX_AGE``）在 ASGI 下的生命周期。
+
+连接按线程保存，能否复用取决于同步代码跑在哪个线程上：
+
+- ASGI 的 HTTP 请求：``ASGIHandler`` 为每个请求进入一个 asgiref ``ThreadSensitiveContext``，
+  请求内所有 ``thread_sensitive`` 的同步调用（中间件、同步视图、异步视图里的
+  ``sync_to_async`` / ``database_sync_to_async``，以及发送 ``request_finished`` 的
+  ``response.close``）都在该请求专属的线程上执行，请求结束后线程随之废弃。
+  持久连接在请求之间无法复用，Django 的 ``close_old_connections`` 又只关闭过期或出错的
+  连接，剩下的连接只能等垃圾回收关闭。
+- 不在请求上下文中的调用（Channels consumer 的 ``database_sync_to_async``）使用 asgiref
+  进程级的单一常驻线程，连接在调用之间复用；后台摘要线程同样复用各自的连接。
+
+因此 ASGI 下 ``CONN_MAX_AGE`` 只对 WebSocket 与后台任务有效，HTTP 请求要复用连接需使用
+连接池后端。``close_request_connections`` 在请求结束时（仍在该请求的线程中）关闭其上的
+持久连接；``CONN_MAX_AGE=0`` 的连接（包括连接池后端）已由 Django 关闭或归还，不再处理。
+WSGI 的工作线程是复用的，不受影响。
+"""
+
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connections
+
+
+def close_request_connections(sender, **kwargs):
+    """request_finished 信号处理：关闭 ASGI 请求线程上仍打开的持久连接。"""
+    if sender is None or not issubclass(sender, ASGIHandler):
+        return
+    for conn in connections.all(initialized_only=True):
+        if conn.connection is not None and conn.settings_dict['CONN_MAX_AGE'] != 0:
+            conn.close()
@@ -0,0 +1,87 @@
+"""聊天历史的游标（keyset）分页。
+
+按 ``(created_at, id)`` 倒序从索引读取，游标为上一页最旧一条消息的
+``<created_at ISO 格式>,<id>``。每页只读取 ``per_page + 1`` 行，
+翻到多深都不需要 OFFSET 扫描，也不需要每次统计总数。
+"""
+
+import uuid
+from datetime import datetime
+
+from django.db.models import Q
+
+from .models import Message
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 100
+
+
+class BadCursor(ValueError):
+    pass
+
+
+def clamp_per_page(value, default=DEFAULT_PER_PAGE) -> int:
+    try:
+        per_page = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+
+def encode_cursor(message) -> str:
+    return f"{message.created_at.isoformat()},{message.pk}"
+
+
+def decode_cursor(value: str):
+    """解析 ``<created_at>,<id>``；查询串中未编码的 ``+`` 会变成空格，这里还原。"""
+    try:
+        created_at, pk = value.replace(' ', '+').rsplit(',', 1)
+        return datetime.fromisoformat(created_at), int(pk)
+    except ValueError as e:
+        raise BadCursor(value) from e
+
+
+def parse_conversation_id(value):
+    try:
+        return uuid.UUID(value)
+    except (TypeError, ValueError) as e:
+        raise BadCursor(value) from e
+
+
+def history_queryset(user, conversation_id=None):
+    messages = Message.objects.filter(user=user, role__in=['user', 'assistant'], is_summary=False)
+    if conversation_id is not None:
+        messages = messages.filter(conversation_id=conversation_id)
+    return messages
+
+
+def history_page(user, before=None, conversation_id=None, per_page=DEFAULT_PER_PAGE):
+    """读取 before 之前（更旧）的 per_page 条消息，返回 (按时间正序的消息, next_cursor)。
+
+    before 为 decode_cursor 的结果，None 表示从最新一条开始；没有更旧的消息时 next_cursor 为 None。
+    """
+    messages = history_queryset(user, conversation_id)
+    if before is not None:
+        created_at, pk = before
+        messages = messages.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+        )
+    rows = list(
+        messages.order_by('-created_at', '-id')
+        .only('id', 'role', 'content', 'created_at', 'conversation_id', 'truncated')[:per_page + 1]
+    )
+    next_cursor = encode_cursor(rows[per_page - 1]) if len(rows) > per_page else None
+    rows = rows[:per_page]
+    rows.reverse()
+    return rows, next_cursor
+
+
+def serialize_message(message) -> dict:
+    return {
+        'id': message.pk,
+        'role': message.role,
+        'content': message.content,
+        'created_at': message.created_at.isoformat(),
+        'conversation_id': str(message.conversation_id),
+        'truncated': message.truncated,
+    }
@@ -0,0 +1,85 @@
+"""
+管理命令：对比每日额度的全表重置与按日期清理的开销
+运行命令：python manage.py bench_quota_reset --totals 1000,10000,50000 --active 500
+
+所有数据在一个最终回滚的事务中生成，不会留在数据库里。
+"""
+
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from chatbot.models import UserSetting
+from chatbot.quota import clear_stale_counts
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = '按总用户数递增、活跃用户数固定，对比全表 UPDATE 与分批清理过期计数的耗时与写入行数'
+
+    header = (
+        f"{'总用户':>10}{'活跃':>8}{'全表行数':>12}{'全表 ms':>10}"
+        f"{'清理行数':>12}{'清理 ms':>10}"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--totals', default='1000,10000,50000', help='逗号分隔的总用户数')
+        parser.add_argument('--active', type=int, default=500, help='前一天发过消息的用户数')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='清理时每批行数')
+
+    def handle(self, *args, **options):
+        totals = [int(t) for t in options['totals'].split(',') if t.strip()]
+        self.stdout.write(self.header)
+        for total in totals:
+            active = min(options['active'], total)
+            full_rows, full_ms = self._measure(total, active, self._full_reset)
+            lazy_rows, lazy_ms = self._measure(
+                total, active, lambda today: clear_stale_counts(today, options['chunk_size'])
+            )
+            self.stdout.write(
+                f"{total:>10}{active:>8}{full_rows:>12}{full_ms:>10.1f}{lazy_rows:>12}{lazy_ms:>10.1f}"
+            )
+
+    @staticmethod
+    def _full_reset(today):
+        # 旧版 reset_daily_counts 的做法
+        with transaction.atomic():
+            return UserSetting.objects.all().update(daily_message_count=0, last_message_date=today)
+
+    def _measure(self, total, active, reset):
+        today = timezone.now().date()
+        result = None
+        try:
+            with transaction.atomic():
+                self._populate(total, active, today - timezone.timedelta(days=1))
+                started = time.perf_counter()
+                rows = reset(today)
+                result = rows, (time.perf_counter() - started) * 1000
+                raise _Rollback()
+        except _Rollback:
+            pass
+        return result
+
+    @staticmethod
+    def _populate(total, active, yesterday):
+        users = User.objects.bulk_create(
+            [User(username=f'bench-quota-{i}') for i in range(total)], batch_size=1000
+        )
+        if users[0].pk is None:  # 部分数据库 bulk_create 不回填主键
+            users = list(User.objects.filter(username__startswith='bench-quota-').order_by('pk'))
+        UserSetting.objects.bulk_create(
+            [
+                UserSetting(
+                    user=user, daily_message_count=5 if i < active else 0,
+                    last_message_date=yesterday,
+                )
+                for i, user in enumerate(users)
+            ],
+            batch_size=500,
+        )
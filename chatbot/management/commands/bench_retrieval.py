@@ -0,0 +1,65 @@
+"""
+管理命令：对比完整默认人设与「精简人设 + wiki 检索」的每轮 prompt token 数与检索耗时
+运行命令：python manage.py bench_retrieval --top-k 4 --repeat 10000
+"""
+
+import time
+from math import ceil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.prompts import DEFAULT_PROMPT
+from chatbot.retrieval import WikiIndex, compose_persona
+
+SAMPLE_QUERIES = [
+    '你好',
+    '西片讨厌吃什么？',
+    '你的女儿叫什么名字',
+    '你平时喜欢做什么',
+    '鹰川堇是谁',
+    '你是什么血型',
+    '你们第一次见面是什么时候',
+    '谁给你配音',
+]
+
+
+def _tokens(text):
+    # 与 Message.save 相同的粗略估算
+    return ceil(len(text) / 4)
+
+
+class Command(BaseCommand):
+    help = '按一组示例输入，对比默认人设与检索拼接人设的 token 估算，并测量单次检索耗时'
+
+    header = f"{'输入':<16}{'默认 token':>12}{'检索 token':>12}{'命中事实':>10}{'检索 µs':>10}"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=4, help='每轮附加的事实条数')
+        parser.add_argument('--repeat', type=int, default=10000, help='每个输入重复检索的次数')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        index = WikiIndex.from_file(settings.WIKI_PATH)
+        build_ms = (time.perf_counter() - started) * 1000
+        self.stdout.write(
+            f"索引：{len(index.facts)} 条事实，{len(index.postings)} 个词项，"
+            f"建索引 {build_ms:.1f} ms"
+        )
+        self.stdout.write(self.header)
+        baseline = _tokens(DEFAULT_PROMPT)
+        total = 0
+        for query in SAMPLE_QUERIES:
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                facts = index.search(query, options['top_k'])
+            micros = (time.perf_counter() - started) * 1e6 / options['repeat']
+            tokens = _tokens(compose_persona(facts))
+            total += tokens
+            self.stdout.write(
+                f"{query:<16}{baseline:>12}{tokens:>12}{len(facts):>10}{micros:>10.1f}"
+            )
+        average = total / len(SAMPLE_QUERIES)
+        self.stdout.write(
+            f"平均每轮人设 token：{baseline} -> {average:.0f}（减少 {1 - average / baseline:.0%}）"
+        )
@@ -0,0 +1,116 @@
+"""
+管理命令：对比 SQLite 默认配置与调优配置（WAL + PRAGMA + BEGIN IMMEDIATE）下的并发回合吞吐
+运行命令：python manage.py bench_sqlite --threads 16 --turns 20
+
+每种配置在临时目录里新建数据库文件并迁移，多个线程各自用独立连接反复执行
+prepare_turn + finish_turn（与真实回合相同的读写），不调用上游模型，也不会改动项目数据库。
+"""
+
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+
+from chatbot.models import BotSetting
+from chatbot.turns import finish_turn, prepare_turn
+
+BASELINE = {'timeout': 5, 'transaction_mode': 'DEFERRED', 'pragmas': {}}
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Command(BaseCommand):
+    help = '在临时数据库上并发执行回合读写，对比默认 SQLite 配置与调优配置的吞吐与锁冲突'
+
+    header = (
+        f"{'配置':<10}{'回合/秒':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'成功':>8}{'锁错误':>8}{'被拒绝':>8}"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='并发线程数（每线程一个用户）')
+        parser.add_argument('--turns', type=int, default=20, help='每个线程执行的回合数')
+
+    def handle(self, *args, **options):
+        settings_dict = connection.settings_dict
+        if settings_dict['ENGINE'] != 'chatbot.backends.sqlite3':
+            self.stderr.write('当前数据库不是 chatbot.backends.sqlite3，跳过')
+            return
+        original = settings_dict['NAME'], settings_dict['OPTIONS']
+        profiles = [('default', BASELINE), ('tuned', original[1])]
+        self.stdout.write(self.header)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                for name, options_ in profiles:
+                    # 新连接按 settings_dict 建立；就地修改后各线程的连接都使用这套配置
+                    connection.close()
+                    settings_dict['NAME'] = os.path.join(tmp, f'{name}.sqlite3')
+                    settings_dict['OPTIONS'] = options_
+                    result = self._run(options['threads'], options['turns'])
+                    self.stdout.write(
+                        f"{name:<10}{result['rate']:>10.1f}{result['p50']:>10.1f}"
+                        f"{result['p95']:>10.1f}{result['p99']:>10.1f}"
+                        f"{result['ok']:>8}{result['locked']:>8}{result['rejected']:>8}"
+                    )
+                    connection.close()
+        finally:
+            settings_dict['NAME'], settings_dict['OPTIONS'] = original
+
+    def _run(self, threads, turns):
+        call_command('migrate', verbosity=0)
+        BotSetting.objects.create(apikey='sk-bench')
+        users = [User.objects.create_user(username=f'bench-sqlite-{i}') for i in range(threads)]
+        connection.close()
+
+        latencies, locked, rejected, lock = [], [0], [0], threading.Lock()
+        # 所有线程同时开始，放大写冲突
+        barrier = threading.Barrier(threads)
+
+        def worker(user):
+            barrier.wait()
+            try:
+                for i in range(turns):
+                    started = time.perf_counter()
+                    try:
+                        turn = prepare_turn(user, f'第 {i} 句')
+                        if turn.error:
+                            # 缺少 API key 或超出每日额度：回合被拒绝，不计入成功
+                            with lock:
+                                rejected[0] += 1
+                            continue
+                        finish_turn(turn, '好的' * 20)
+                    except OperationalError as e:
+                        if 'locked' not in str(e):
+                            raise
+                        with lock:
+                            locked[0] += 1
+                        continue
+                    with lock:
+                        latencies.append((time.perf_counter() - started) * 1000)
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(worker, users))
+        elapsed = time.perf_counter() - started
+        return {
+            'rate': len(latencies) / elapsed,
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99),
+            'ok': len(latencies),
+            'locked': locked[0],
+            'rejected': rejected[0],
+        }
@@ -0,0 +1,70 @@
+"""
+管理命令：对比流式增量逐条发送与合并发送的帧数与 CPU 开销
+运行命令：python manage.py bench_stream_frames --streams 50 --tokens 400 --rate 100
+"""
+
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbot.streaming import DeltaCoalescer
+
+
+class Command(BaseCommand):
+    help = '模拟多路并发的逐字流式回复，对比逐条发送与合并发送的帧数/秒与每 token CPU 时间'
+
+    header = (
+        f"{'模式':<8}{'帧数':>10}{'帧/秒':>12}"
+        f"{'CPU µs/token':>16}{'发送 µs/token':>16}{'耗时 s':>10}"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', type=int, default=50, help='并发流数量')
+        parser.add_argument('--tokens', type=int, default=400, help='每路流的 token（增量）数')
+        parser.add_argument('--rate', type=float, default=100.0, help='每路流每秒产出的 token 数')
+        parser.add_argument('--interval-ms', type=int, default=50, help='合并模式的攒帧间隔')
+        parser.add_argument('--bytes', type=int, default=256, help='合并模式的字节阈值')
+
+    def handle(self, *args, **options):
+        modes = [
+            ('逐条发送', 0, 1),
+            ('合并发送', options['interval_ms'] / 1000, options['bytes']),
+        ]
+        self.stdout.write(self.header)
+        total_tokens = options['streams'] * options['tokens']
+        for name, interval, nbytes in modes:
+            frames, wall, cpu, send_time = asyncio.run(self._run(options, interval, nbytes))
+            per_token = 1e6 / total_tokens
+            self.stdout.write(
+                f"{name:<8}{frames:>10}{frames / wall:>12.0f}"
+                f"{cpu * per_token:>16.2f}{send_time * per_token:>16.2f}{wall:>10.2f}"
+            )
+
+    async def _run(self, options, interval, nbytes):
+        sink = []
+        send_time = 0.0
+
+        async def send(text):
+            nonlocal send_time
+            started = time.perf_counter()
+            # 与 ChatConsumer.send_json 相同的编码开销，外加按帧编码为 UTF-8 字节
+            sink.append(json.dumps({"delta": text}, ensure_ascii=False).encode('utf-8'))
+            send_time += time.perf_counter() - started
+
+        async def one_stream():
+            coalescer = DeltaCoalescer(send, flush_interval=interval, flush_bytes=nbytes)
+            delay = 1 / options['rate']
+            for i in range(options['tokens']):
+                await coalescer.push('高木西片'[i % 4])
+                await asyncio.sleep(delay)
+            await coalescer.close()
+            return coalescer.frames
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        frames = await asyncio.gather(*(one_stream() for _ in range(options['streams'])))
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        return sum(frames), wall, cpu, send_time
@@ -0,0 +1,332 @@
+"""
+管理命令：对运行中的服务（daphne）发起并发 WebSocket 与 HTTP（SSE）对话压测
+运行命令：
+    python manage.py mock_openai --port 8001 &
+    daphne -p 8000 django_chatbot.asgi:application &
+    python manage.py loadtest --url http://127.0.0.1:8000 --upstream http://127.0.0.1:8001/v1 \\
+        --ws-clients 20 --http-clients 20 --turns 5
+
+压测用户 loadtest-<n> 的自定义 Key/Base URL 指向 --upstream，不消耗真实额度，也不受每日限额影响。
+报告首 token 时间（TTFT）、回合耗时 p50/p95/p99 与回合/秒。每回合数据库查询数在被测进程中
+无法从外部读取，压测前在本进程内通过同一个 ASGI 应用先跑 --calibrate 个回合统计得到。
+"""
+
+import asyncio
+import base64
+import json
+import math
+import os
+import struct
+import threading
+import time
+from urllib.parse import urlparse
+
+import httpx
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.crypto import get_random_string
+
+from chatbot.models import UserSetting
+
+
+class _Result:
+    __slots__ = ('transport', 'ttft', 'latency', 'error')
+
+    def __init__(self, transport, ttft, latency, error):
+        self.transport = transport
+        self.ttft = ttft
+        self.latency = latency
+        self.error = error
+
+
+class _QueryCounter:
+    """挂到本进程所有数据库连接上的查询计数器（含线程池中的连接）。"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        for conn in connections.all():
+            conn.execute_wrappers.append(self)
+        connection_created.connect(self._on_connection, weak=False)
+
+    def _on_connection(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+class _WebSocket:
+    """基于 asyncio 流的最小 WebSocket 客户端（RFC 6455 文本帧），无需额外依赖。
+
+    daphne 的 autobahn 已绑定 twisted，不能在同一进程内再用其 asyncio 客户端。
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, url, cookie):
+        parsed = urlparse(url)
+        reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port or 80)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            f"GET {parsed.path or '/'} HTTP/1.1\r\nHost: {parsed.netloc}\r\n"
+            f"Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+            f"Sec-WebSocket-Version: 13\r\nCookie: {cookie}\r\n\r\n"
+        ).encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in head.split(b'\r\n', 1)[0]:
+            writer.close()
+            raise ConnectionError(head.split(b'\r\n', 1)[0].decode(errors='replace'))
+        return cls(reader, writer)
+
+    async def send_json_to(self, data):
+        self._send_frame(0x1, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        await self.writer.drain()
+
+    async def receive_json_from(self, timeout=None):
+        return json.loads(await asyncio.wait_for(self._receive_text(), timeout))
+
+    async def disconnect(self):
+        self._send_frame(0x8, struct.pack('!H', 1000))
+        self.writer.close()
+
+    def _send_frame(self, opcode, payload):
+        # 客户端发出的帧必须加掩码
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.writer.write(header + mask + masked)
+
+    async def _receive_text(self):
+        parts = []
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7f
+            if length == 126:
+                (length,) = struct.unpack('!H', await self.reader.readexactly(2))
+            elif length == 127:
+                (length,) = struct.unpack('!Q', await self.reader.readexactly(8))
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0f
+            if opcode == 0x8:
+                raise ConnectionError('websocket closed')
+            if opcode == 0x9:
+                self._send_frame(0xa, payload)
+                continue
+            if opcode in (0x0, 0x1):
+                parts.append(payload)
+                if first & 0x80:
+                    return b''.join(parts).decode('utf-8')
+
+
+class Command(BaseCommand):
+    help = '并发驱动 WebSocket 与 HTTP 对话客户端，报告 TTFT、回合耗时分位数、回合/秒与每回合查询数'
+
+    header = (
+        f"{'通道':<6}{'回合':>7}{'错误':>6}{'TTFT p50':>10}{'TTFT p95':>10}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'回合/秒':>9}{'查询/回合':>10}"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='被测服务地址')
+        parser.add_argument(
+            '--upstream', default='http://127.0.0.1:8001/v1', help='mock 上游地址（mock_openai）'
+        )
+        parser.add_argument('--ws-clients', type=int, default=10, help='并发 WebSocket 客户端数')
+        parser.add_argument('--http-clients', type=int, default=10, help='并发 HTTP 客户端数')
+        parser.add_argument('--turns', type=int, default=5, help='每个客户端的对话轮数')
+        parser.add_argument('--message', default='今天一起回家吗？', help='每轮发送的消息')
+        parser.add_argument('--model', default='deepseek-chat', help='压测用户使用的模型')
+        parser.add_argument('--timeout', type=float, default=30.0, help='单个回合的超时秒数')
+        parser.add_argument(
+            '--calibrate', type=int, default=3,
+            help='统计查询数时每种通道在进程内跑的回合数，0 跳过',
+        )
+
+    def handle(self, *args, **options):
+        total = options['ws_clients'] + options['http_clients']
+        cookies = [self._login(f'loadtest-{i}', options) for i in range(total + 2)]
+        queries = {}
+        if options['calibrate'] > 0:
+            queries = asyncio.run(self._calibrate(cookies[-2:], options))
+        results, wall = asyncio.run(self._run(cookies[:total], options))
+
+        self.stdout.write(self.header)
+        for transport in ('ws', 'http'):
+            rows = [r for r in results if r.transport == transport]
+            if rows:
+                self._report(transport, rows, wall, queries.get(transport))
+        if results:
+            self._report('全部', results, wall, None)
+
+    def _login(self, username, options):
+        user, created = User.objects.get_or_create(username=username)
+        if created:
+            user.set_unusable_password()
+            user.save(update_fields=['password'])
+        UserSetting.objects.update_or_create(user=user, defaults={
+            'user_api_key': 'sk-mock', 'user_base_url': options['upstream'],
+            'modelName': options['model'],
+        })
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        csrf_token = get_random_string(32)
+        return (
+            f"{settings.SESSION_COOKIE_NAME}={session.session_key}; "
+            f"{settings.CSRF_COOKIE_NAME}={csrf_token}",
+            csrf_token,
+        )
+
+    async def _run(self, cookies, options):
+        ws_url = urlparse(options['url'])._replace(scheme='ws', path='/ws/chat/').geturl()
+        results = []
+        clients = []
+        for i, (cookie, csrf_token) in enumerate(cookies):
+            if i < options['ws_clients']:
+                connect = _WebSocket.connect(ws_url, cookie)
+                clients.append(self._ws_client(connect, options, results))
+            else:
+                client = httpx.AsyncClient(base_url=options['url'], timeout=options['timeout'])
+                clients.append(self._http_client(client, cookie, csrf_token, options, results))
+        started = time.perf_counter()
+        await asyncio.gather(*clients)
+        return results, time.perf_counter() - started
+
+    async def _ws_client(self, connect, options, results):
+        try:
+            socket = await connect
+            await socket.receive_json_from(options['timeout'])  # welcome
+        except Exception as e:
+            results.append(_Result('ws', None, None, f'connect: {e}'))
+            return
+        try:
+            for _ in range(options['turns']):
+                results.append(await self._ws_turn(socket, options))
+        finally:
+            await socket.disconnect()
+
+    @staticmethod
+    async def _ws_turn(socket, options):
+        started = time.perf_counter()
+        ttft = None
+        await socket.send_json_to({'message': options['message']})
+        while True:
+            try:
+                event = await socket.receive_json_from(options['timeout'])
+            except Exception as e:
+                return _Result('ws', ttft, None, f'receive: {e!r}')
+            if 'delta' in event and ttft is None:
+                ttft = time.perf_counter() - started
+            elif event.get('done'):
+                return _Result('ws', ttft, time.perf_counter() - started, None)
+            elif 'error' in event:
+                return _Result('ws', ttft, time.perf_counter() - started, event['error'])
+
+    async def _http_client(self, client, cookie, csrf_token, options, results):
+        async with client:
+            for _ in range(options['turns']):
+                results.append(await self._http_turn(client, cookie, csrf_token, options))
+
+    @staticmethod
+    async def _http_turn(client, cookie, csrf_token, options):
+        started = time.perf_counter()
+        ttft = None
+        headers = {'Cookie': cookie, 'X-CSRFToken': csrf_token}
+        try:
+            async with client.stream(
+                'POST', '/api/chat/stream', data={'message': options['message']}, headers=headers
+            ) as response:
+                if response.status_code != 200:
+                    return _Result('http', None, None, f'http {response.status_code}')
+                async for line in response.aiter_lines():
+                    if not line.startswith('data: '):
+                        continue
+                    event = json.loads(line[6:])
+                    if 'delta' in event and ttft is None:
+                        ttft = time.perf_counter() - started
+                    elif event.get('done'):
+                        return _Result('http', ttft, time.perf_counter() - started, None)
+                    elif 'error' in event:
+                        return _Result('http', ttft, time.perf_counter() - started, event['error'])
+        except Exception as e:
+            return _Result('http', ttft, None, f'request: {e!r}')
+        return _Result('http', ttft, None, 'stream ended without done')
+
+    async def _calibrate(self, cookies, options):
+        """在本进程内用同一个 ASGI 应用跑若干回合，统计每回合的数据库查询数。"""
+        from django_chatbot.asgi import application
+
+        counter = _QueryCounter()
+        counter.install()
+        turns = options['calibrate']
+        queries = {}
+
+        (ws_cookie, _), (http_cookie, csrf_token) = cookies
+        socket = WebsocketCommunicator(
+            application, '/ws/chat/', headers=[(b'cookie', ws_cookie.encode())]
+        )
+        await socket.connect()
+        await socket.receive_json_from(options['timeout'])
+        before = counter.count
+        for _ in range(turns):
+            await self._ws_turn(socket, options)
+        queries['ws'] = (counter.count - before) / turns
+        await socket.disconnect()
+
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url='http://localhost') as client:
+            before = counter.count
+            for _ in range(turns):
+                await self._http_turn(client, http_cookie, csrf_token, options)
+            queries['http'] = (counter.count - before) / turns
+        return queries
+
+    def _report(self, transport, rows, wall, queries):
+        ok = [r for r in rows if r.error is None]
+        ttfts = sorted(r.ttft for r in ok if r.ttft is not None)
+        latencies = sorted(r.latency for r in ok)
+        per_turn = '-' if queries is None else f'{queries:.1f}'
+        self.stdout.write(
+            f"{transport:<6}{len(rows):>7}{len(rows) - len(ok):>6}"
+            f"{_ms(ttfts, 50):>10}{_ms(ttfts, 95):>10}"
+            f"{_ms(latencies, 50):>9}{_ms(latencies, 95):>9}{_ms(latencies, 99):>9}"
+            f"{len(ok) / wall:>9.1f}{per_turn:>10}"
+        )
+        errors = {}
+        for r in rows:
+            if r.error is not None:
+                errors[r.error] = errors.get(r.error, 0) + 1
+        for error, count in sorted(errors.items(), key=lambda item: -item[1])[:5]:
+            self.stdout.write(f"  {count} × {error}")
+
+
+def _percentile(sorted_values, p):
+    """最近秩法分位数，sorted_values 须已升序排列。"""
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def _ms(sorted_values, p):
+    return f"{_percentile(sorted_values, p) * 1000:.0f}" if sorted_values else '-'
@@ -0,0 +1,50 @@
+"""
+管理命令：启动本地的 OpenAI 兼容接口替身（见 chatbot/mock_openai.py）
+运行命令：python manage.py mock_openai --port 8001 --rate 50 --latency 0.2 --error-rate 0.01
+
+压测时把被测服务的 OPENAI_BASE_URL（或压测用户的自定义 Base URL）指向 http://127.0.0.1:8001/v1。
+"""
+
+from daphne.server import Server
+from django.core.management.base import BaseCommand
+
+from chatbot.mock_openai import MockOpenAI
+
+
+class Command(BaseCommand):
+    help = '启动可配置 token 速率、首 token 延迟与错误注入的本地 OpenAI 兼容接口'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--rate', type=float, default=50.0, help='每秒输出的 token 数')
+        parser.add_argument('--latency', type=float, default=0.2, help='首个 token 前的等待秒数')
+        parser.add_argument('--tokens', type=int, default=60, help='每条回复的 token 数')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='返回错误的概率')
+        parser.add_argument('--error-status', type=int, default=500, help='注入错误的 HTTP 状态码')
+        parser.add_argument(
+            '--missing-model', action='append', default=None,
+            help='视为不存在的模型名，可重复；默认 no-such-model',
+        )
+        parser.add_argument('--seed', type=int, default=None, help='错误注入的随机种子')
+
+    def handle(self, *args, **options):
+        app = MockOpenAI(
+            token_rate=options['rate'],
+            first_token_latency=options['latency'],
+            reply_tokens=options['tokens'],
+            error_rate=options['error_rate'],
+            error_status=options['error_status'],
+            missing_models=options['missing_model'] or ('no-such-model',),
+            seed=options['seed'],
+        )
+        self.stdout.write(
+            f"mock OpenAI 接口：http://{options['host']}:{options['port']}/v1 "
+            f"（{options['rate']:g} token/s，首 token {options['latency']:g}s，"
+            f"错误率 {options['error_rate']:g}）"
+        )
+        Server(
+            application=app,
+            endpoints=[f"tcp:port={options['port']}:interface={options['host']}"],
+            verbosity=0,
+        ).run()
@@ -0,0 +1,91 @@
+"""
+管理命令：查看采样 profiler 写入 PROFILING_DIR 的结果
+运行命令：
+    python manage.py profiles list --name chatbot --limit 20
+    python manage.py profiles aggregate --name get_chat_history --sort tottime --top 30
+    python manage.py profiles clear
+"""
+
+import io
+import json
+import os
+import pstats
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = '列出、汇总或清空采样 profiler 的结果（cProfile 统计 + 请求元数据）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['list', 'aggregate', 'clear'])
+        parser.add_argument('--name', help='只看某个视图，如 chatbot、get_chat_history')
+        parser.add_argument('--limit', type=int, default=0, help='只取最新的 N 份（0 为全部）')
+        parser.add_argument('--sort', default='cumulative',
+                            help='aggregate 的排序键，同 pstats：cumulative/tottime/ncalls 等')
+        parser.add_argument('--top', type=int, default=25, help='aggregate 输出的函数行数')
+
+    def handle(self, *args, **opts):
+        directory = settings.PROFILING_DIR
+        entries = self._entries(directory, opts['name'])
+        if opts['limit']:
+            entries = entries[-opts['limit']:]
+        getattr(self, f"_{opts['action']}")(entries, opts)
+
+    def _entries(self, directory, name):
+        if not os.path.isdir(directory):
+            return []
+        entries = []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('.prof'):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path[:-len('.prof')] + '.json', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = {}
+            if name and meta.get('name') != name:
+                continue
+            entries.append((path, meta))
+        return entries
+
+    def _list(self, entries, opts):
+        self.stdout.write(
+            f"{'开始时间':<34}{'名称':<18}{'触发':<8}{'用户':<16}{'状态':>6}{'耗时 ms':>12}  路径"
+        )
+        for _, meta in entries:
+            status = meta.get('status')
+            self.stdout.write(
+                f"{meta.get('started_at', '?'):<34}{meta.get('name', '?'):<18}"
+                f"{meta.get('trigger', '?'):<8}{meta.get('user') or '-':<16}"
+                f"{'-' if status is None else status:>6}{meta.get('duration_ms', 0):>12.1f}"
+                f"  {meta.get('method', '')} {meta.get('path', '')}"
+            )
+        self.stdout.write(f'共 {len(entries)} 份')
+
+    def _aggregate(self, entries, opts):
+        if not entries:
+            raise CommandError('没有匹配的 profile')
+        out = io.StringIO()
+        stats = pstats.Stats(*(path for path, _ in entries), stream=out)
+        durations = sorted(meta.get('duration_ms', 0) for _, meta in entries)
+        self.stdout.write(
+            f'汇总 {len(entries)} 份，请求耗时中位数 {durations[len(durations) // 2]:.1f} ms，'
+            f'最大 {durations[-1]:.1f} ms'
+        )
+        try:
+            stats.strip_dirs().sort_stats(opts['sort']).print_stats(opts['top'])
+        except KeyError as e:
+            raise CommandError(f"未知的排序键: {opts['sort']}") from e
+        self.stdout.write(out.getvalue())
+
+    def _clear(self, entries, opts):
+        for path, _ in entries:
+            for target in (path, path[:-len('.prof')] + '.json'):
+                try:
+                    os.remove(target)
+                except FileNotFoundError:
+                    pass
+        self.stdout.write(f'已删除 {len(entries)} 份')
@@ -1,19 +1,22 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from django.db import transaction
 
-from chatbot.models import UserSetting
+from chatbot.quota import clear_stale_counts
 
 
 class Command(BaseCommand):
-    help = "Reset daily_message_count for all users (should be run daily at midnight)."
+    help = (
+        "Optional cleanup: zero daily_message_count on rows left over from previous days. "
+        "Quotas reset lazily per date, so running this is no longer required."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每个事务清理的行数')
 
     def handle(self, *args, **options):
-        today = timezone.localdate()
-        with transaction.atomic():
-            qs = UserSetting.objects.all()
-            updated = qs.update(daily_message_count=0, last_message_date=today)
+        today = timezone.now().date()
+        cleared = clear_stale_counts(today=today, chunk_size=options['chunk_size'])
 
         self.stdout.write(self.style.SUCCESS(
-            f"Reset daily_message_count for {updated} user settings to 0 (date set to {today})."
+            f"Cleared stale daily_message_count on {cleared} user settings (before {today})."
         ))
@@ -0,0 +1,230 @@
+"""进程内指标与 Prometheus 文本格式导出（``/metrics``）。
+
+回合各阶段的耗时先记在 ``TurnContext.spans`` 里，回合结束时由 ``record_turn``
+按 (model, key_source) 标签一次性写入直方图，热路径上只有几次 ``perf_counter``
+与字典写入。数据库查询由连接上的 execute wrapper 计数，按当前线程所处的阶段
+（``query_phase``）打标签。
+
+没有引入 prometheus_client：这里只需要计数器与直方图两种类型，
+自带实现没有额外依赖，每次观测一次加锁与一次二分查找。
+指标只统计当前进程，多进程部署时由 Prometheus 分别抓取各进程后聚合。
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from channels.db import database_sync_to_async
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+FRAME_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_registry = []
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            values = tuple(str(v) for v in values)
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, values, child):
+        return [f'{self.name}_total{self._label_text(values)} {child.value:g}']
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts, total, count = list(child.counts), child.sum, child.count
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            lines.append(f'{self.name}_bucket{self._label_text(values, [("le", le)])} {cumulative}')
+        lines.append(f'{self.name}_sum{self._label_text(values)} {total:g}')
+        lines.append(f'{self.name}_count{self._label_text(values)} {count}')
+        return lines
+
+
+TURN_PHASE_SECONDS = Histogram(
+    'chat_turn_phase_seconds',
+    '对话回合各阶段耗时：thread_wait/db_prepare/queue/upstream_ttft/upstream/stream/persist/total',
+    ('phase', 'model', 'key_source'),
+)
+TURN_TOKENS_PER_SECOND = Histogram(
+    'chat_turn_tokens_per_second', '流式回复从首个增量到结束的增量速率',
+    ('model', 'key_source'), buckets=RATE_BUCKETS,
+)
+TURN_FRAMES = Histogram(
+    'chat_turn_frames', '每个回合发给客户端的 delta 帧数', ('model', 'key_source'),
+    buckets=FRAME_BUCKETS,
+)
+TURNS = Counter(
+    'chat_turns', '结束的对话回合数，按结果分类', ('model', 'key_source', 'outcome'),
+)
+SUMMARY_PHASE_SECONDS = Histogram(
+    'chat_summary_phase_seconds', '后台摘要各阶段耗时：db_load/upstream/persist',
+    ('phase', 'model'),
+)
+SUMMARIES = Counter('chat_summaries', '摘要任务数，按结果分类', ('model', 'outcome'))
+DB_QUERIES = Counter('chat_db_queries', '数据库查询数，按所处阶段分类', ('phase',))
+
+
+def key_source(turn) -> str:
+    return 'user' if turn.user_setting.user_api_key else 'shared'
+
+
+def record_turn(turn, outcome, tokens=0, stream_seconds=0.0, frames=0):
+    """回合结束时把 turn.spans 写入直方图并计数。"""
+    labels = (turn.model_name or 'unknown', key_source(turn))
+    spans = turn.spans
+    spans['total'] = time.perf_counter() - turn.started_at + spans.get('thread_wait', 0.0)
+    for phase, seconds in spans.items():
+        TURN_PHASE_SECONDS.labels(phase, *labels).observe(seconds)
+    if tokens and stream_seconds > 0:
+        TURN_TOKENS_PER_SECOND.labels(*labels).observe(tokens / stream_seconds)
+    if frames:
+        TURN_FRAMES.labels(*labels).observe(frames)
+    TURNS.labels(*labels, outcome).inc()
+
+
+async def timed_sync(phase, fn, *args, **kwargs):
+    """在数据库线程中执行 fn，返回 (结果, 等待线程的秒数, 执行秒数)；期间的查询记在 phase 下。"""
+    submitted = time.perf_counter()
+
+    def run():
+        started = time.perf_counter()
+        with query_phase(phase):
+            result = fn(*args, **kwargs)
+        return result, started - submitted, time.perf_counter() - started
+
+    return await database_sync_to_async(run)()
+
+
+_local = threading.local()
+
+
+@contextmanager
+def query_phase(phase):
+    previous = getattr(_local, 'phase', 'other')
+    _local.phase = phase
+    try:
+        yield
+    finally:
+        _local.phase = previous
+
+
+def count_query(execute, sql, params, many, context):
+    DB_QUERIES.labels(getattr(_local, 'phase', 'other')).inc()
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """connection_created 信号处理：给每个新建的数据库连接挂上查询计数。"""
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def _runtime_gauges():
+    from .admission import admission
+    from .context_cache import context_cache
+    from .response_cache import response_cache
+
+    admission_stats = admission.stats()
+    gauges = [
+        ('chat_admission_active', '正在调用上游的回合数', admission_stats['active']),
+        ('chat_admission_waiting', '准入排队中的回合数', admission_stats['waiting']),
+        ('chat_context_cache_conversations', '上下文缓存中的会话数',
+         context_cache.stats()['conversations']),
+        ('chat_response_cache_hit_ratio', '首轮回复缓存命中率', response_cache.stats()['hit_rate']),
+    ]
+    lines = []
+    for name, documentation, value in gauges:
+        lines += [f'# HELP {name} {documentation}', f'# TYPE {name} gauge', f'{name} {value:g}']
+    return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    lines.extend(_runtime_gauges())
+    return '\n'.join(lines) + '\n'
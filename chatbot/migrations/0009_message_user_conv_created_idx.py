@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0008_usersetting_daily_message_count_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['user', 'conversation_id', 'created_at'],
+                name='message_user_conv_created_idx',
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0009_message_user_conv_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='summary_covers_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0010_message_summary_covers_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='truncated',
+            field=models.BooleanField(default=False),
+        ),
+    ]
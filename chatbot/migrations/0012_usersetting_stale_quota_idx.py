@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0011_message_truncated'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usersetting',
+            index=models.Index(
+                condition=models.Q(('daily_message_count__gt', 0)),
+                fields=['last_message_date'],
+                name='usersetting_stale_quota_idx',
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0012_usersetting_stale_quota_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['user', '-created_at', '-id'], name='message_user_created_id_idx'
+            ),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:25
+
+import uuid
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatbot', '0013_message_user_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.UUIDField(
+                    default=uuid.uuid4, editable=False, primary_key=True, serialize=False,
+                )),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('message_count', models.IntegerField(default=0)),
+                ('token_total', models.IntegerField(default=0)),
+                ('is_active', models.BooleanField(default=True)),
+                ('latest_summary', models.ForeignKey(
+                    blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                    related_name='+', to='chatbot.message',
+                )),
+                ('user', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='conversations',
+                    to=settings.AUTH_USER_MODEL,
+                )),
+            ],
+        ),
+        migrations.AddField(
+            model_name='usersetting',
+            name='active_conversation',
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+', to='chatbot.conversation',
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', 'is_active'], name='conversation_user_active_idx'),
+        ),
+    ]
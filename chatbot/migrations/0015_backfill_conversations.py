@@ -0,0 +1,66 @@
+from django.db import migrations
+from django.db.models import Count, Max, Min, Q, Sum
+
+
+def backfill_conversations(apps, schema_editor):
+    """为已有消息按 (user, conversation_id) 建立 Conversation，并设置用户的当前会话。
+
+    当前会话沿用旧逻辑：用户最早的 system 消息所在的会话。
+    """
+    Message = apps.get_model('chatbot', 'Message')
+    Conversation = apps.get_model('chatbot', 'Conversation')
+    UserSetting = apps.get_model('chatbot', 'UserSetting')
+
+    groups = (
+        Message.objects.values('user_id', 'conversation_id')
+        .annotate(
+            message_count=Count('id', filter=Q(role__in=['user', 'assistant'], is_summary=False)),
+            token_total=Sum('tokens'),
+            first_at=Min('created_at'),
+            last_message_at=Max('created_at'),
+            latest_summary_id=Max('id', filter=Q(is_summary=True)),
+        )
+        .order_by()
+    )
+    batch = []
+    for group in groups.iterator():
+        batch.append(Conversation(
+            id=group['conversation_id'],
+            user_id=group['user_id'],
+            last_message_at=group['last_message_at'],
+            message_count=group['message_count'],
+            token_total=group['token_total'] or 0,
+            latest_summary_id=group['latest_summary_id'],
+            is_active=False,
+        ))
+        if len(batch) >= 500:
+            Conversation.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    Conversation.objects.bulk_create(batch, ignore_conflicts=True)
+    # auto_now_add 在 bulk_create 时取当前时间，改为会话第一条消息的时间
+    for group in groups.iterator():
+        Conversation.objects.filter(pk=group['conversation_id']).update(created_at=group['first_at'])
+
+    first_system = (
+        Message.objects.filter(role='system')
+        .order_by('user_id', 'created_at', 'id')
+        .values_list('user_id', 'conversation_id')
+    )
+    seen = set()
+    for user_id, conversation_id in first_system.iterator():
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        Conversation.objects.filter(pk=conversation_id).update(is_active=True)
+        UserSetting.objects.filter(user_id=user_id).update(active_conversation_id=conversation_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0014_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
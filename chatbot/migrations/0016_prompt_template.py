@@ -0,0 +1,46 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0015_backfill_conversations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PromptTemplate',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='prompt_template',
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.PROTECT,
+                related_name='+', to='chatbot.prompttemplate',
+            ),
+        ),
+        migrations.AddField(
+            model_name='usersetting',
+            name='prompt_jp_template',
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.PROTECT,
+                related_name='+', to='chatbot.prompttemplate',
+            ),
+        ),
+        migrations.AddField(
+            model_name='usersetting',
+            name='prompt_template',
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.PROTECT,
+                related_name='+', to='chatbot.prompttemplate',
+            ),
+        ),
+    ]
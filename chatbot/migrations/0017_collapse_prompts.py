@@ -0,0 +1,91 @@
+import hashlib
+from math import ceil
+
+from django.db import migrations
+from django.db.models import F
+
+
+def collapse_prompts(apps, schema_editor):
+    """把每个用户的 prompt/promptJP 与每个会话的首条 system 消息合并到 PromptTemplate。
+
+    会话的人设改由 Conversation.prompt_template 引用，原 system 消息删除。
+    """
+    PromptTemplate = apps.get_model('chatbot', 'PromptTemplate')
+    UserSetting = apps.get_model('chatbot', 'UserSetting')
+    Conversation = apps.get_model('chatbot', 'Conversation')
+    Message = apps.get_model('chatbot', 'Message')
+    known = {}
+
+    def intern(text):
+        if not text:
+            return None
+        digest = known.get(text)
+        if digest is None:
+            digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            PromptTemplate.objects.get_or_create(digest=digest, defaults={'content': text})
+            known[text] = digest
+        return digest
+
+    for setting in UserSetting.objects.only('pk', 'prompt', 'promptJP').iterator():
+        UserSetting.objects.filter(pk=setting.pk).update(
+            prompt_template_id=intern(setting.prompt),
+            prompt_jp_template_id=intern(setting.promptJP),
+        )
+
+    first_system = (
+        Message.objects.filter(role='system', is_summary=False)
+        .order_by('conversation_id', 'created_at', 'id')
+        .values_list('id', 'conversation_id', 'content', 'tokens')
+    )
+    seen = set()
+    for message_id, conversation_id, content, tokens in first_system.iterator():
+        if conversation_id in seen:
+            continue
+        seen.add(conversation_id)
+        updated = Conversation.objects.filter(pk=conversation_id).update(
+            prompt_template_id=intern(content), token_total=F('token_total') - tokens
+        )
+        if updated:
+            Message.objects.filter(pk=message_id).delete()
+
+
+def restore_prompts(apps, schema_editor):
+    PromptTemplate = apps.get_model('chatbot', 'PromptTemplate')
+    UserSetting = apps.get_model('chatbot', 'UserSetting')
+    Conversation = apps.get_model('chatbot', 'Conversation')
+    Message = apps.get_model('chatbot', 'Message')
+    contents = dict(PromptTemplate.objects.values_list('digest', 'content'))
+
+    for setting in UserSetting.objects.only(
+        'pk', 'prompt_template_id', 'prompt_jp_template_id'
+    ).iterator():
+        updates = {}
+        if setting.prompt_template_id:
+            updates['prompt'] = contents[setting.prompt_template_id]
+        if setting.prompt_jp_template_id:
+            updates['promptJP'] = contents[setting.prompt_jp_template_id]
+        if updates:
+            UserSetting.objects.filter(pk=setting.pk).update(**updates)
+
+    for conversation in Conversation.objects.exclude(prompt_template=None).iterator():
+        content = contents[conversation.prompt_template_id]
+        tokens = ceil(len(content) / 4)
+        message = Message.objects.create(
+            user_id=conversation.user_id, role='system', content=content, tokens=tokens,
+            conversation_id=conversation.pk,
+        )
+        Message.objects.filter(pk=message.pk).update(created_at=conversation.created_at)
+        Conversation.objects.filter(pk=conversation.pk).update(
+            token_total=F('token_total') + tokens, prompt_template=None
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0016_prompt_template'),
+    ]
+
+    operations = [
+        migrations.RunPython(collapse_prompts, restore_prompts),
+    ]
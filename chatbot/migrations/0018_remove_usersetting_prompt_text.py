@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0017_collapse_prompts'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='usersetting',
+            name='prompt',
+        ),
+        migrations.RemoveField(
+            model_name='usersetting',
+            name='promptJP',
+        ),
+    ]
@@ -0,0 +1,133 @@
+"""本地的 OpenAI 兼容接口替身，供压测与离线调试使用，不产生真实费用。
+
+``MockOpenAI`` 是一个 ASGI 应用，实现 ``GET /v1/models`` 与 ``POST /v1/chat/completions``
+（流式与非流式）。首个 token 前等待 ``first_token_latency`` 秒，之后按 ``token_rate``
+个/秒逐字输出固定的回复；按 ``error_rate`` 的概率返回 ``error_status`` 错误；
+``missing_models`` 中的模型返回与上游一致的 “model does not exist” 400 错误，
+用于验证模型回退路径。
+
+由 ``python manage.py mock_openai`` 通过 daphne 启动。
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import time
+
+REPLY = "西片，你刚才是不是又在想怎么捉弄我？我全都看出来了哦。下次可要藏好一点，不然还是我赢。"
+
+
+class MockOpenAI:
+    def __init__(self, token_rate=50.0, first_token_latency=0.2, reply_tokens=60,
+                 error_rate=0.0, error_status=500, missing_models=('no-such-model',), seed=None):
+        self.token_rate = token_rate
+        self.first_token_latency = first_token_latency
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.missing_models = set(missing_models)
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self.requests = 0
+        self.errors = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        path = scope['path'].rstrip('/')
+        if scope['method'] == 'GET' and path.endswith('/models'):
+            models = [{"id": "deepseek-chat", "object": "model", "owned_by": "mock"}]
+            await _send_json(send, 200, {"object": "list", "data": models})
+        elif scope['method'] == 'POST' and path.endswith('/chat/completions'):
+            await self.chat_completions(json.loads(body or b'{}'), send)
+        else:
+            await _send_json(send, 404, _error(f"Unknown path {scope['path']}", 'not_found'))
+
+    async def chat_completions(self, request, send):
+        self.requests += 1
+        model = request.get('model', '')
+        if model in self.missing_models:
+            self.errors += 1
+            await _send_json(send, 400, _error(
+                f"The model `{model}` does not exist", 'invalid_request_error', 'model_not_found'
+            ))
+            return
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            error = _error('Injected mock failure', 'server_error')
+            await _send_json(send, self.error_status, error)
+            return
+
+        completion_id = f"chatcmpl-mock-{next(self._ids)}"
+        tokens = [REPLY[i % len(REPLY)] for i in range(self.reply_tokens)]
+        await asyncio.sleep(self.first_token_latency)
+        if not request.get('stream'):
+            await asyncio.sleep(len(tokens) / self.token_rate)
+            await _send_json(send, 200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0, "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": ''.join(tokens)},
+                }],
+                "usage": _usage(request, len(tokens)),
+            })
+            return
+
+        await send({
+            'type': 'http.response.start', 'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')],
+        })
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(1 / self.token_rate)
+            delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+            await _send_event(send, _chunk(completion_id, model, delta, None))
+        await _send_event(send, _chunk(completion_id, model, {}, 'stop'))
+        await send({'type': 'http.response.body', 'body': b'data: [DONE]\n\n'})
+
+
+def _chunk(completion_id, model, delta, finish_reason):
+    return {
+        "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def _usage(request, completion_tokens):
+    # 与 Message.save 相同的粗略估算
+    prompt_chars = sum(len(m.get('content') or '') for m in request.get('messages', []))
+    prompt_tokens = (prompt_chars + 3) // 4
+    return {
+        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _error(message, error_type, code=None):
+    return {"error": {"message": message, "type": error_type, "param": None, "code": code}}
+
+
+async def _send_event(send, payload):
+    data = f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8')
+    await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start', 'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,148 @@
+"""进程级 OpenAI 客户端注册表。
+
+按 (api_key, base_url) 复用 ``OpenAI`` / ``AsyncOpenAI`` 实例，所有实例共享同一个
+keep-alive 的 httpx 连接池，避免每个回合重新建连、TLS 握手与 DNS 解析。
+注册表容量有限（LRU 淘汰）且会淘汰空闲过久的条目，用户自带 Key 再多也不会无限增长。
+模型不存在时的回退规则也在这里，供各调用路径共用。
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+import httpx
+from django.conf import settings
+from openai import AsyncOpenAI, OpenAI
+
+
+def default_model_name() -> str:
+    return getattr(settings, 'OPENAI_DEFAULT_MODEL', 'gpt-3.5-turbo')
+
+
+def fallback_model(model_name: str) -> str:
+    """模型不存在时切换到的模型：配置的默认模型，已是默认则用 gpt-3.5-turbo。"""
+    configured_default = default_model_name()
+    return 'gpt-3.5-turbo' if model_name == configured_default else configured_default
+
+
+def is_model_missing(error) -> bool:
+    text = str(error).lower()
+    return 'model' in text and 'exist' in text
+
+
+def _http_limits():
+    return httpx.Limits(
+        max_connections=getattr(settings, 'OPENAI_HTTP_MAX_CONNECTIONS', 100),
+        max_keepalive_connections=getattr(settings, 'OPENAI_HTTP_MAX_KEEPALIVE', 20),
+        keepalive_expiry=getattr(settings, 'OPENAI_HTTP_KEEPALIVE_EXPIRY', 60.0),
+    )
+
+
+class ClientRegistry:
+    """线程安全的 LRU 客户端缓存，带空闲超时与命中统计。"""
+
+    def __init__(self, factory, max_size=None, idle_timeout=None, clock=time.monotonic):
+        self._factory = factory
+        self.max_size = max_size or getattr(settings, 'OPENAI_CLIENT_CACHE_SIZE', 256)
+        self.idle_timeout = idle_timeout or getattr(settings, 'OPENAI_CLIENT_IDLE_TIMEOUT', 600)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (client, last_used)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, api_key, base_url=None):
+        key = (api_key, base_url or None)
+        now = self._clock()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._entries[key] = (entry[0], now)
+                self._entries.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+            client = self._factory(api_key, base_url or None)
+            self._entries[key] = (client, now)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return client
+
+    def _evict_idle(self, now):
+        # 有序字典按最近使用排序，只需从最久未用的一端检查
+        while self._entries:
+            key, (_, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            del self._entries[key]
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class _SyncPool:
+    def __init__(self):
+        self.http_client = None
+        self.registry = ClientRegistry(self._create)
+
+    def _create(self, api_key, base_url):
+        if self.http_client is None:
+            self.http_client = httpx.Client(limits=_http_limits(), follow_redirects=True)
+        return OpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client)
+
+
+class _AsyncPool:
+    """httpx.AsyncClient 的连接绑定在创建它的事件循环上，换循环时整体重建。"""
+
+    def __init__(self):
+        self.http_client = None
+        self.loop = None
+        self.registry = ClientRegistry(self._create)
+
+    def bind(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.registry.clear()
+            self.http_client = None
+            self.loop = loop
+
+    def _create(self, api_key, base_url):
+        if self.http_client is None:
+            self.http_client = httpx.AsyncClient(limits=_http_limits(), follow_redirects=True)
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client)
+
+
+_sync_pool = _SyncPool()
+_async_pool = _AsyncPool()
+
+
+def get_sync_client(api_key, base_url=None) -> OpenAI:
+    return _sync_pool.registry.get(api_key, base_url)
+
+
+def get_async_client(api_key, base_url=None) -> AsyncOpenAI:
+    """须在事件循环内调用。"""
+    _async_pool.bind()
+    return _async_pool.registry.get(api_key, base_url)
+
+
+def client_stats():
+    return {
+        'sync': _sync_pool.registry.stats(),
+        'async': _async_pool.registry.stats(),
+    }
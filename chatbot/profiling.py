@@ -0,0 +1,190 @@
+"""按采样开启的 cProfile 钩子（默认关闭，``PROFILING_ENABLED=True`` 开启）。
+
+``profiled(name)`` 装饰视图，满足以下任一条件的请求会被完整 profile：
+
+- 请求带有 ``PROFILING_HEADER`` 头且值与 ``PROFILING_TOKEN`` 相同（未设置 token 时不按请求头触发）；
+- 当前用户名或 id 在 ``PROFILING_USERS`` 中；
+- 按 ``PROFILING_SAMPLE_RATE``（0~1）随机抽中。
+
+结果以 ``.prof``（``pstats`` 可读）写入 ``PROFILING_DIR``，旁边的同名 ``.json``
+记录请求名、路径、用户、触发原因与耗时，最多保留 ``PROFILING_MAX_FILES`` 份。
+``python manage.py profiles`` 列出与汇总。
+
+同一进程同一时间只 profile 一个请求，其它请求照常执行、不采样。
+
+cProfile 按线程生效：异步视图运行在事件循环线程上，profile 期间同一循环上所有连接的
+协程都会被计入结果，也都要承担 profiler 的开销。因此只用于很快返回的视图，
+不要装饰流式回复或 WebSocket consumer 这类长时间运行的入口。
+"""
+
+import asyncio
+import cProfile
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+
+logger = logging.getLogger(__name__)
+
+_active = threading.Lock()
+
+
+def _enabled() -> bool:
+    return getattr(settings, 'PROFILING_ENABLED', False)
+
+
+def _configured_users():
+    raw = getattr(settings, 'PROFILING_USERS', '')
+    return {u.strip() for u in raw.split(',') if u.strip()}
+
+
+def _header_trigger(headers) -> bool:
+    header = getattr(settings, 'PROFILING_HEADER', 'X-Profile')
+    token = getattr(settings, 'PROFILING_TOKEN', '')
+    value = headers.get(header)
+    return bool(token) and value is not None and constant_time_compare(value, token)
+
+
+def _user_trigger(user, users) -> bool:
+    return bool(user and user.is_authenticated and ({user.username, str(user.pk)} & users))
+
+
+def _sample_trigger() -> bool:
+    rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+    return rate > 0 and random.random() < rate
+
+
+async def _request_trigger(request):
+    """返回触发原因或 None；只有配置了 PROFILING_USERS 时才去加载用户。"""
+    if _header_trigger(request.headers):
+        return 'header'
+    users = _configured_users()
+    # request.user 是惰性对象，首次访问会读 session，放到线程中求值
+    if users and await sync_to_async(_user_trigger)(request.user, users):
+        return 'user'
+    return 'sample' if _sample_trigger() else None
+
+
+def _sync_request_trigger(request):
+    if _header_trigger(request.headers):
+        return 'header'
+    users = _configured_users()
+    if users and _user_trigger(request.user, users):
+        return 'user'
+    return 'sample' if _sample_trigger() else None
+
+
+def _metadata(name, trigger, request):
+    return {
+        'name': name,
+        'trigger': trigger,
+        'method': request.method,
+        'path': request.path,
+        'started_at': datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def _username(request):
+    # 视图执行后认证中间件已把用户缓存在 request._cached_user 上，这里不再查库
+    user = getattr(request, '_cached_user', None)
+    return user.username if user is not None and user.is_authenticated else None
+
+
+def save_profile(profile, meta):
+    directory = getattr(settings, 'PROFILING_DIR', 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{meta['name']}-{uuid.uuid4().hex[:8]}"
+    profile.dump_stats(os.path.join(directory, stem + '.prof'))
+    with open(os.path.join(directory, stem + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    _prune(directory, getattr(settings, 'PROFILING_MAX_FILES', 500))
+
+
+def _prune(directory, max_files):
+    profiles = sorted(f for f in os.listdir(directory) if f.endswith('.prof'))
+    for filename in profiles[:max(len(profiles) - max_files, 0)]:
+        for path in (filename, filename[:-len('.prof')] + '.json'):
+            try:
+                os.remove(os.path.join(directory, path))
+            except FileNotFoundError:
+                pass
+
+
+def _finish(profile, meta, started, status, request):
+    profile.disable()
+    meta['duration_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    meta['status'] = status
+    meta['user'] = _username(request)
+
+
+def profiled(name):
+    """装饰视图函数（同步或异步）；异步视图的注意事项见模块说明。"""
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(request, *args, **kwargs):
+                if not _enabled():
+                    return await func(request, *args, **kwargs)
+                trigger = await _request_trigger(request)
+                if trigger is None or not _active.acquire(blocking=False):
+                    return await func(request, *args, **kwargs)
+                try:
+                    meta = _metadata(name, trigger, request)
+                    profile, started, status = cProfile.Profile(), time.perf_counter(), None
+                    profile.enable()
+                    try:
+                        response = await func(request, *args, **kwargs)
+                        status = response.status_code
+                        return response
+                    finally:
+                        _finish(profile, meta, started, status, request)
+                        await _save_in_thread(profile, meta)
+                finally:
+                    _active.release()
+        else:
+            @functools.wraps(func)
+            def wrapper(request, *args, **kwargs):
+                if not _enabled():
+                    return func(request, *args, **kwargs)
+                trigger = _sync_request_trigger(request)
+                if trigger is None or not _active.acquire(blocking=False):
+                    return func(request, *args, **kwargs)
+                try:
+                    meta = _metadata(name, trigger, request)
+                    profile, started, status = cProfile.Profile(), time.perf_counter(), None
+                    profile.enable()
+                    try:
+                        response = func(request, *args, **kwargs)
+                        status = response.status_code
+                        return response
+                    finally:
+                        _finish(profile, meta, started, status, request)
+                        _save_quietly(profile, meta)
+                finally:
+                    _active.release()
+
+        return wrapper
+
+    return decorator
+
+
+def _save_quietly(profile, meta):
+    try:
+        save_profile(profile, meta)
+    except OSError:
+        logger.exception('failed to save profile %s', meta['name'])
+
+
+async def _save_in_thread(profile, meta):
+    # 不在事件循环线程上写文件
+    await asyncio.get_running_loop().run_in_executor(None, _save_quietly, profile, meta)
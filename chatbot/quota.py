@@ -0,0 +1,68 @@
+"""每日对话额度。
+
+额度的检查与占用在一条带日期条件的 UPDATE 中完成，不先读后写，多个标签页并发发送
+也不会超额或丢失计数；只写 ``daily_message_count`` 与 ``last_message_date`` 两列，
+不会重写 ``prompt`` 等大字段。回合开始时占用一个名额，未能得到回复时退还。
+
+计数只对 ``last_message_date`` 当天有效，新的一天在首次占用时惰性重置，
+不需要每天午夜重写全表；``clear_stale_counts`` 只是可选的清理。
+"""
+
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from .models import UserSetting
+
+# 非超级用户且未配置专属 API Key 时的每日免费对话条数
+DAILY_MESSAGE_LIMIT = 50
+
+
+def _today():
+    return timezone.now().date()
+
+
+def reserve_slot(user_id, limit=DAILY_MESSAGE_LIMIT, today=None) -> bool:
+    """占用当日的一个名额；已用完时返回 False。
+
+    日期不是今天的记录视为新的一天，计数直接置为 1。检查与占用是同一条 UPDATE。
+    """
+    today = today or _today()
+    stale = ~Q(last_message_date=today)
+    updated = UserSetting.objects.filter(
+        Q(user_id=user_id) & (stale | Q(last_message_date=today, daily_message_count__lt=limit))
+    ).update(
+        daily_message_count=Case(
+            When(last_message_date=today, then=F('daily_message_count') + 1),
+            default=Value(1),
+        ),
+        last_message_date=today,
+    )
+    return updated == 1
+
+
+def refund_slot(user_id, today=None) -> bool:
+    """退还当日占用的名额；跨天后旧名额已随日期失效，不再退还。"""
+    today = today or _today()
+    updated = UserSetting.objects.filter(
+        user_id=user_id, last_message_date=today, daily_message_count__gt=0
+    ).update(daily_message_count=F('daily_message_count') - 1)
+    return updated == 1
+
+
+def clear_stale_counts(today=None, chunk_size=1000):
+    """分批把以前日期残留的非零计数清零，逐批提交，返回清理的行数。
+
+    只触及计数非零且日期过期的行（有部分索引），开销与前一天的活跃用户数成正比。
+    """
+    today = today or _today()
+    stale = UserSetting.objects.filter(daily_message_count__gt=0, last_message_date__lt=today)
+    cleared = 0
+    while True:
+        with transaction.atomic():
+            ids = list(
+                stale.order_by('last_message_date').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not ids:
+                return cleared
+            cleared += UserSetting.objects.filter(pk__in=ids).update(daily_message_count=0)
@@ -0,0 +1,130 @@
+"""首轮回复缓存（默认关闭，``RESPONSE_CACHE_ENABLED=True`` 开启）。
+
+很多会话以相同的寒暄开场，上下文只有默认人设与这一句话，回复与用户无关。
+这类首轮消息按 (规范化输入, prompt 摘要, 模型, base_url) 缓存回复，命中时不调用上游。
+
+每个键最多保存 ``RESPONSE_CACHE_VARIANTS`` 条不同的回复：攒满之前仍按未命中处理并
+把新回复加入候选，攒满之后随机返回其中一条，避免同一句话总得到一模一样的回答。
+条目超过 ``RESPONSE_CACHE_TTL`` 秒过期，总数超过 ``RESPONSE_CACHE_MAX_ENTRIES`` 时按 LRU 淘汰。
+缓存只在当前进程内有效。
+"""
+
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from django.conf import settings
+
+_spaces = re.compile(r'\s+')
+# 结尾的语气符号不影响回复，如「你好！」与「你好」
+_trailing_punct = re.compile(r'[\s!?.,~。！？，、…～]+$')
+
+
+def normalize_input(text: str) -> str:
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return _trailing_punct.sub('', _spaces.sub(' ', text).strip())
+
+
+class _Entry:
+    __slots__ = ('variants', 'expires_at')
+
+    def __init__(self, expires_at):
+        self.variants = []
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """带 TTL 的 LRU 缓存，每个键保存若干条候选回复。"""
+
+    def __init__(self, max_entries=None, ttl=None, variants=None, clock=time.monotonic,
+                 choice=random.choice):
+        self.max_entries = max_entries or getattr(settings, 'RESPONSE_CACHE_MAX_ENTRIES', 1024)
+        self.ttl = ttl or getattr(settings, 'RESPONSE_CACHE_TTL', 3600)
+        self.variants = variants or getattr(settings, 'RESPONSE_CACHE_VARIANTS', 3)
+        self._clock = clock
+        self._choice = choice
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """候选已攒满时随机返回一条，否则返回 None（调用方应请求上游并 put 结果）。"""
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None or len(entry.variants) < self.variants:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._choice(entry.variants)
+
+    def put(self, key, reply):
+        if not reply:
+            return
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at <= now:
+                # 过期时间从第一条候选写入时算起，到期后整组重新收集
+                entry = _Entry(now + self.ttl)
+                self._entries[key] = entry
+            if reply in entry.variants or len(entry.variants) >= self.variants:
+                return
+            entry.variants.append(reply)
+            self.stores += 1
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+response_cache = ResponseCache()
+
+
+def cache_enabled() -> bool:
+    return getattr(settings, 'RESPONSE_CACHE_ENABLED', False)
+
+
+def first_turn_key(turn, prompt_digest):
+    """回合可缓存时返回缓存键，否则返回 None。
+
+    只缓存使用共享凭据、上下文恰为「人设 + 本条输入」的首轮消息；
+    用户自带 Key 或旧会话（人设仍存于消息表）不缓存。
+    """
+    if not cache_enabled() or not prompt_digest or turn.user_setting.user_api_key:
+        return None
+    if len(turn.send_chat) != 2 or turn.send_chat[-1]['role'] != 'user':
+        return None
+    text = normalize_input(turn.send_chat[-1]['content'])
+    if not text or len(text) > getattr(settings, 'RESPONSE_CACHE_MAX_INPUT_CHARS', 32):
+        return None
+    return (text, prompt_digest, turn.model_name, turn.base_url)
@@ -0,0 +1,127 @@
+"""人物设定检索（默认关闭，``WIKI_RETRIEVAL_ENABLED=True`` 开启）。
+
+``DEFAULT_PROMPT`` 把所有人物细节塞进每一轮的 system 消息，占去上下文预算的一大块。
+开启后，使用默认人设的会话改用精简的 ``CORE_PROMPT``，再按本轮输入从
+``wiki/takagi-main.json`` 中检索最相关的 ``WIKI_RETRIEVAL_TOP_K`` 条事实附在其后。
+
+wiki 在启动时（``ChatbotConfig.ready``）展平为一条条「路径：值」形式的事实，建立内存倒排索引，
+按 BM25 打分。中日文没有空格分词，连续的 CJK 字符按二元组（bigram）切分，
+拉丁字母与数字按词切分。每个词项的 BM25 权重在建索引时预先算好，
+查询只需累加倒排表中的权重，单次检索为微秒级。
+"""
+
+import heapq
+import json
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+
+from django.conf import settings
+
+from .prompts import CORE_PROMPT, DEFAULT_PROMPT_DIGEST
+
+K1 = 1.5
+B = 0.75
+
+_runs = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]+|[a-z0-9]+')
+_cjk = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]')
+# 不是事实的元数据键
+_SKIP_KEYS = {'数据来源'}
+
+
+def tokenize(text: str):
+    tokens = []
+    for run in _runs.findall(unicodedata.normalize('NFKC', text).casefold()):
+        if not _cjk.match(run) or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def flatten_facts(data, path=()):
+    """把嵌套的 wiki JSON 展平为 ``高木·兴趣：散步、漫画`` 形式的事实列表。
+
+    短词列表合并为一条，句子列表每句一条。
+    """
+    facts = []
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key not in _SKIP_KEYS:
+                facts.extend(flatten_facts(value, path + (key,)))
+    elif isinstance(data, list):
+        if all(isinstance(item, str) and len(item) <= 12 for item in data):
+            facts.append(f"{'·'.join(path)}：{'、'.join(data)}")
+        else:
+            for item in data:
+                facts.extend(flatten_facts(item, path))
+    elif data not in (None, ''):
+        facts.append(f"{'·'.join(path)}：{data}")
+    return facts
+
+
+class WikiIndex:
+    """事实列表上的 BM25 倒排索引。"""
+
+    def __init__(self, facts):
+        self.facts = list(facts)
+        docs = [Counter(tokenize(fact)) for fact in self.facts]
+        total = len(docs)
+        avg_len = sum(sum(doc.values()) for doc in docs) / total if total else 0
+        doc_freq = Counter(term for doc in docs for term in doc)
+        postings = defaultdict(list)
+        for doc_id, doc in enumerate(docs):
+            norm = K1 * (1 - B + B * sum(doc.values()) / avg_len)
+            for term, tf in doc.items():
+                df = doc_freq[term]
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                postings[term].append((doc_id, idf * tf * (K1 + 1) / (tf + norm)))
+        # 建好后只读，元组更紧凑
+        self.postings = {term: tuple(entries) for term, entries in postings.items()}
+
+    def search(self, query: str, top_k: int):
+        """返回得分最高的 top_k 条事实（得分为 0 的不返回），按得分降序。"""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            for doc_id, weight in self.postings.get(term, ()):
+                scores[doc_id] += weight
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [self.facts[doc_id] for doc_id, _ in best]
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(flatten_facts(json.load(f)))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def retrieval_enabled() -> bool:
+    return getattr(settings, 'WIKI_RETRIEVAL_ENABLED', False)
+
+
+def load_index():
+    """读取 ``WIKI_PATH`` 并建立索引；启动时调用一次，之后复用。"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = WikiIndex.from_file(settings.WIKI_PATH)
+        return _index
+
+
+def compose_persona(facts):
+    if not facts:
+        return CORE_PROMPT
+    return CORE_PROMPT + "\n\n与本轮对话相关的设定：\n" + "\n".join(f"- {fact}" for fact in facts)
+
+
+def persona_for_turn(prompt_digest, persona, user_input):
+    """本轮实际使用的人设文本：默认人设换成精简人设加检索到的事实，自定义人设原样返回。"""
+    if not retrieval_enabled() or prompt_digest != DEFAULT_PROMPT_DIGEST:
+        return persona
+    index = _index or load_index()
+    return compose_persona(index.search(user_input, getattr(settings, 'WIKI_RETRIEVAL_TOP_K', 4)))
@@ -0,0 +1,232 @@
+"""流式回复：调用上游、合并增量并以 delta/done/error 事件发送。
+
+WebSocket（``ChatConsumer``）与 SSE（``views.chat_stream``）共用 ``stream_turn``，
+两条路径的事件格式一致。
+
+模型逐 token 返回增量，逐条发送意味着每个字符一次 ``json.dumps`` 与一帧。
+``DeltaCoalescer`` 把增量攒到一定字节数或时间间隔后再合并成一帧发出；
+首个增量总是立即发送，不影响首字延迟。前端按增量追加文本，合并后显示不变。
+"""
+
+import asyncio
+import json
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from openai import BadRequestError
+
+from .admission import AdmissionTimeout, admission, admission_pool
+from .metrics import record_turn, timed_sync
+from .openai_clients import get_async_client
+from .response_cache import response_cache
+from .summaries import schedule_summary
+from .turns import finish_turn, refund_turn
+
+
+class DeltaCoalescer:
+    """按 flush_interval（秒）与 flush_bytes 合并增量；interval 为 0 时逐条发送。"""
+
+    def __init__(self, send, flush_interval=None, flush_bytes=None, clock=time.monotonic):
+        self._send = send  # async callable(text)
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'CHAT_STREAM_FLUSH_INTERVAL_MS', 50) / 1000
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes or getattr(settings, 'CHAT_STREAM_FLUSH_BYTES', 256)
+        self._clock = clock
+        self._buffer = []
+        self._nbytes = 0
+        self._last_flush = 0.0
+        self._timer = None
+        self._pending = None
+        self.frames = 0
+
+    async def push(self, delta: str):
+        if not delta:
+            return
+        self._buffer.append(delta)
+        self._nbytes += len(delta.encode('utf-8'))
+        if (
+            self.frames == 0
+            or self.flush_interval <= 0
+            or self._nbytes >= self.flush_bytes
+            or self._clock() - self._last_flush >= self.flush_interval
+        ):
+            await self.flush()
+        elif self._timer is None:
+            # 上游停顿时也要按时把已攒的内容发出去
+            delay = max(self.flush_interval - (self._clock() - self._last_flush), 0)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._pending = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        self._cancel_timer()
+        if not self._buffer:
+            return
+        text = ''.join(self._buffer)
+        self._buffer.clear()
+        self._nbytes = 0
+        self.frames += 1
+        self._last_flush = self._clock()
+        await self._send(text)
+
+    async def close(self):
+        """发送剩余内容；须在发送 done 之前调用。"""
+        if self._pending is not None and not self._pending.done():
+            await self._pending
+        await self.flush()
+
+    def discard(self):
+        """出错时丢弃未发送的内容并取消定时器。"""
+        self._cancel_timer()
+        self._buffer.clear()
+        self._nbytes = 0
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+def turn_error_event(turn):
+    """prepare_turn 失败时发给客户端的事件。"""
+    if turn.error == 'daily_limit_exceeded':
+        return {"error": "daily_limit_exceeded", "message": "您今天的免费对话额度已用完。"}
+    return {"error": turn.error}
+
+
+async def stream_turn(turn, emit):
+    """执行一次流式回合，事件通过 ``await emit(event)`` 发出。
+
+    上游调用前先经准入控制排队，排队期间发送 ``{"type": "queue", "position": n}``。
+    命中首轮回复缓存时既不排队也不调用上游，缓存的回复同样分段以 delta 事件发出。
+    保存助手回复后发送 done，之后才按需调度后台摘要。任务被取消（用户停止或断开连接）时
+    关闭上游 HTTP 流，把已生成的部分标记为 truncated 保存，然后继续抛出 CancelledError。
+    排队、首 token、流式与保存各阶段的耗时记入 ``turn.spans``，结束时写入指标。
+    """
+    client = get_async_client(turn.api_key, turn.base_url)
+    # 增量合并成较少的帧，首个增量立即发送
+    coalescer = DeltaCoalescer(lambda text: emit({"delta": text}))
+    stream = None
+    full = []
+    first_at = last_at = None
+    outcome = 'error'
+    cached = response_cache.get(turn.cache_key) if turn.cache_key else None
+    try:
+        if cached is not None:
+            for piece in _chunks(cached):
+                full.append(piece)
+                await coalescer.push(piece)
+        else:
+            queued_at = time.perf_counter()
+            async with admission.slot(
+                turn.user.pk, admission_pool(turn),
+                on_position=lambda n: emit({"type": "queue", "position": n}),
+            ):
+                requested_at = time.perf_counter()
+                turn.spans['queue'] = requested_at - queued_at
+                stream = await client.chat.completions.create(
+                    model=turn.model_name, messages=turn.send_chat, stream=True
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content or ''
+                    if delta:
+                        last_at = time.perf_counter()
+                        if first_at is None:
+                            first_at = last_at
+                            turn.spans['upstream_ttft'] = first_at - requested_at
+                        full.append(delta)
+                        await coalescer.push(delta)
+        await coalescer.close()
+        final_text = ''.join(full).strip()
+        # 回复为空时 finish_turn 不写入并退还额度
+        _, _, turn.spans['persist'] = await timed_sync('persist', finish_turn, turn, final_text)
+        await emit({"done": True})
+        outcome = ('cached' if cached is not None else 'ok') if final_text else 'empty'
+        if turn.cache_key and cached is None:
+            response_cache.put(turn.cache_key, final_text)
+        if turn.needs_summary:
+            # 回复已送达，摘要在后台线程池中生成
+            schedule_summary(turn)
+    except asyncio.CancelledError:
+        outcome = 'truncated'
+        coalescer.discard()
+        if stream is not None:
+            await _close_quietly(stream)
+        partial = ''.join(full).strip()
+        # 再次取消也不能丢掉已生成的部分
+        await asyncio.shield(
+            database_sync_to_async(finish_turn)(turn, partial, truncated=True)
+        )
+        raise
+    except AdmissionTimeout:
+        outcome = 'queue_timeout'
+        await database_sync_to_async(refund_turn)(turn)
+        await emit({"error": "queue_timeout", "message": "当前请求较多，请稍后再试。"})
+    except BadRequestError as e:
+        outcome = 'model_error'
+        coalescer.discard()
+        await database_sync_to_async(refund_turn)(turn)
+        await emit({"error": f"model_error: {e}"})
+    except Exception as e:
+        coalescer.discard()
+        await database_sync_to_async(refund_turn)(turn)
+        await emit({"error": f"exception: {e}"})
+    finally:
+        if first_at is not None:
+            turn.spans['stream'] = last_at - first_at
+        record_turn(
+            turn, outcome, tokens=len(full), stream_seconds=turn.spans.get('stream', 0.0),
+            frames=coalescer.frames,
+        )
+
+
+def _chunks(text, size=16):
+    """把缓存的回复切成小段，经合并器发出时与上游增量一致。"""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+async def _close_quietly(stream):
+    """关闭上游响应，释放连接并让上游停止生成。"""
+    try:
+        await stream.close()
+    except Exception:
+        pass
+
+
+async def sse_events(turn):
+    """把 stream_turn 的事件转换为 Server-Sent Events 文本块的异步迭代器。
+
+    迭代器被关闭时取消生成任务，由 stream_turn 关闭上游并保存部分回复。注意 Django 4.2
+    的 ASGI handler 在发送流式响应期间不监听 ``http.disconnect``，客户端断开后迭代器
+    不会立即被关闭：生成会继续到回复结束，期间仍占用上游流与准入名额。
+    只有 WebSocket 的 stop 消息与断开能及时取消生成。
+    """
+    queue = asyncio.Queue()
+    finished = object()
+
+    async def run():
+        try:
+            await stream_turn(turn, queue.put)
+        finally:
+            await queue.put(finished)
+
+    task = asyncio.ensure_future(run())
+    try:
+        while True:
+            event = await queue.get()
+            if event is finished:
+                break
+            yield sse_format(event)
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def sse_format(event) -> str:
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
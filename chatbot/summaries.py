@@ -0,0 +1,214 @@
+"""会话摘要：超过阈值后在后台生成，不阻塞用户可见的回复。
+
+``finish_turn`` 在保存助手回复的同一事务里判断是否越过
+``generate_summary_num * 2`` 阈值；调用方在回复送达之后调用 ``schedule_summary``，
+任务提交到进程内线程池执行。同一会话同时最多只有一个任务，任务开始时会重新检查阈值，
+重复提交是安全的；删除旧消息与替换摘要在同一事务中完成。
+
+摘要是增量的：每次只把上一份摘要和它覆盖范围之后的消息交给模型，
+单次摘要的开销与新增消息数成正比，而不是与整段会话成正比。
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from openai import BadRequestError
+
+from .context_cache import context_cache
+from .conversations import refresh_stats
+from .metrics import SUMMARIES, SUMMARY_PHASE_SECONDS, query_phase
+from .models import Message
+from .openai_clients import fallback_model, get_sync_client, is_model_missing
+
+logger = logging.getLogger(__name__)
+
+# 摘要后保留的最近消息条数，避免上下文衔接突兀
+KEEP_RECENT_MESSAGES = 2
+
+
+@dataclass(frozen=True)
+class SummaryJob:
+    user_id: int
+    conversation_id: object
+    api_key: str
+    base_url: object
+    model_name: str
+    summary_cmd: str
+    threshold: int
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'SUMMARY_MAX_WORKERS', 2),
+                thread_name_prefix='chat-summary',
+            )
+        return _executor
+
+
+def summary_threshold(user_setting) -> int:
+    return user_setting.generate_summary_num * 2
+
+
+def count_unsummarized(user_id, conversation_id) -> int:
+    return Message.objects.filter(
+        user_id=user_id, conversation_id=conversation_id,
+        role__in=['user', 'assistant'], is_summary=False,
+    ).count()
+
+
+def schedule_summary(turn) -> bool:
+    """为回合所在会话提交摘要任务；已有任务在跑时返回 False。"""
+    job = SummaryJob(
+        user_id=turn.user.pk,
+        conversation_id=turn.conversation_id,
+        api_key=turn.api_key,
+        base_url=turn.base_url,
+        model_name=turn.model_name,
+        summary_cmd=turn.summary_cmd,
+        threshold=summary_threshold(turn.user_setting),
+    )
+    with _in_flight_lock:
+        if job.conversation_id in _in_flight:
+            return False
+        _in_flight.add(job.conversation_id)
+    if getattr(settings, 'SUMMARY_ASYNC', True):
+        _get_executor().submit(_run_in_worker, job)
+    else:
+        _release_after(job)
+    return True
+
+
+def _run_in_worker(job):
+    close_old_connections()
+    try:
+        _release_after(job)
+    finally:
+        close_old_connections()
+
+
+def _release_after(job):
+    try:
+        with query_phase('summary'):
+            run_summary_job(job)
+    except Exception:
+        logger.exception('summary job failed for conversation %s', job.conversation_id)
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(job.conversation_id)
+
+
+def latest_summary(user_id, conversation_id):
+    return (
+        Message.objects.filter(user_id=user_id, conversation_id=conversation_id, is_summary=True)
+        .order_by('-id').first()
+    )
+
+
+def covered_id(summary) -> int:
+    """摘要已覆盖的最大消息 id；旧版本生成的摘要没有记录，视为覆盖其之前的全部消息。"""
+    if summary is None:
+        return 0
+    return summary.summary_covers_id or summary.id
+
+
+def build_summary_input(previous, delta):
+    """增量摘要的输入：上一份摘要 + 其后的新消息。"""
+    send_chat = []
+    if previous is not None:
+        send_chat.append({"role": "system", "content": f"此前对话的摘要：{previous.content}"})
+    send_chat.extend({"role": m.role, "content": m.content} for m in delta)
+    return send_chat
+
+
+def run_summary_job(job: SummaryJob):
+    """执行一次增量摘要；阈值未越过、没有新消息或模型调用失败时不做任何修改。
+
+    只把上一份摘要和它之后的新消息交给模型，生成一份替换用的新摘要，
+    并记录其覆盖到的消息 id，同一条消息不会被摘要两次。返回新摘要消息或 None。
+    """
+    started = time.perf_counter()
+    if count_unsummarized(job.user_id, job.conversation_id) <= job.threshold:
+        SUMMARIES.labels(job.model_name, 'skipped').inc()
+        return None
+    previous = latest_summary(job.user_id, job.conversation_id)
+    # 只处理任务开始时已存在的消息，摘要期间新到的回合不受影响
+    delta = list(
+        Message.objects.filter(
+            user_id=job.user_id, conversation_id=job.conversation_id,
+            role__in=['user', 'assistant'], is_summary=False, id__gt=covered_id(previous),
+        ).order_by('id').only('id', 'role', 'content')
+    )
+    if not delta:
+        SUMMARIES.labels(job.model_name, 'skipped').inc()
+        return None
+    SUMMARY_PHASE_SECONDS.labels('db_load', job.model_name).observe(time.perf_counter() - started)
+    covers_id = delta[-1].id
+    client = get_sync_client(job.api_key, job.base_url)
+    summary_text = generate_summary(
+        client, job.model_name, build_summary_input(previous, delta), job.summary_cmd
+    )
+    if not summary_text:
+        SUMMARIES.labels(job.model_name, 'failed').inc()
+        return None
+
+    persist_at = time.perf_counter()
+    with transaction.atomic():
+        conversation = Message.objects.filter(
+            user_id=job.user_id, conversation_id=job.conversation_id
+        )
+        recent = conversation.filter(role__in=['user', 'assistant'], is_summary=False)
+        newest = recent.order_by('-created_at', '-id').values_list('id', flat=True)
+        keep_ids = list(newest[:KEEP_RECENT_MESSAGES])
+        recent.filter(id__lte=covers_id).exclude(id__in=keep_ids).delete()
+        conversation.filter(is_summary=True).delete()
+        summary = Message.objects.create(
+            user_id=job.user_id, role='system', content=summary_text, is_summary=True,
+            conversation_id=job.conversation_id, summary_covers_id=covers_id,
+        )
+        refresh_stats(job.conversation_id, latest_summary=summary)
+        transaction.on_commit(lambda: context_cache.invalidate(job.conversation_id))
+    persist_seconds = time.perf_counter() - persist_at
+    SUMMARY_PHASE_SECONDS.labels('persist', job.model_name).observe(persist_seconds)
+    SUMMARIES.labels(job.model_name, 'ok').inc()
+    return summary
+
+
+def generate_summary(client, model_name, current_send_chat, summary_cmd_local):
+    """生成摘要文本。current_send_chat 为上一份摘要与待摘要的新消息。"""
+    # 添加一条用户指令 summary 到临时消息副本
+    temp = current_send_chat + [{"role": "user", "content": summary_cmd_local}]
+
+    def _invoke(model: str):
+        started = time.perf_counter()
+        try:
+            return client.chat.completions.create(model=model, messages=temp)
+        finally:
+            SUMMARY_PHASE_SECONDS.labels('upstream', model).observe(time.perf_counter() - started)
+
+    tried_fallback = False
+    while True:
+        try:
+            response = _invoke(model_name)
+            return response.choices[0].message.content.strip()
+        except BadRequestError as e:
+            if not tried_fallback and is_model_missing(e):
+                tried_fallback = True
+                model_name = fallback_model(model_name)
+                continue
+            return None
+        except Exception:
+            return None
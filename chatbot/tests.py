@@ -1,7 +1,49 @@
-from django.test import TestCase, Client
+import asyncio
+import gzip
+import io
+import json
+import os
+import tempfile
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+import httpx
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
 from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from .models import UserSetting, Message, Chat
+from django.utils import timezone
+from openai import APIStatusError, AsyncOpenAI, BadRequestError
+
+from django_chatbot.database import parse_database_url
+
+from .admin import UserSettingForm
+from .admission import OWN_KEY_POOL, SHARED_POOL, AdmissionController, AdmissionTimeout
+from .backends.sqlite3.base import DatabaseWrapper as SqliteDatabaseWrapper
+from .consumers import ChatConsumer
+from .context import build_context, load_context
+from .context_cache import ContextCache, context_cache
+from .db_connections import close_request_connections
+from .metrics import count_query, install_query_counter
+from .mock_openai import MockOpenAI
+from .models import BotSetting, Chat, Conversation, Message, PromptTemplate, UserSetting
+from .openai_clients import ClientRegistry, fallback_model, is_model_missing
+from .prompts import CORE_PROMPT, DEFAULT_PROMPT, prompt_digest
+from .quota import DAILY_MESSAGE_LIMIT, clear_stale_counts, refund_slot, reserve_slot
+from .response_cache import ResponseCache, normalize_input, response_cache
+from .retrieval import WikiIndex, flatten_facts, tokenize
+from .streaming import DeltaCoalescer
+from .summaries import schedule_summary
+from .turns import finish_turn, prepare_turn, refund_turn
 
 
 class ChatBasicTest(TestCase):
@@ -9,10 +51,923 @@ class ChatBasicTest(TestCase):
 		self.client = Client()
 		self.user = User.objects.create_user(username='u1', password='pass12345')
 		UserSetting.objects.create(user=self.user)
+		BotSetting.objects.create(apikey='sk-test')
 
-	def test_post_message_creates_chat_and_message(self):
+	def test_post_message_saves_user_and_assistant_messages(self):
 		self.client.login(username='u1', password='pass12345')
-		resp = self.client.post(reverse('chatbot'), {'message': '你好'})
+		with mock.patch(
+			'chatbot.views.get_async_client', return_value=fake_async_client(['你好呀'])
+		):
+			resp = self.client.post(reverse('chatbot'), {'message': '你好'})
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(resp.json()['response'], '你好呀')
+		# 对话只写入 Message 表，旧的 Chat 表不再使用
+		self.assertFalse(Chat.objects.exists())
+		self.assertEqual(
+			list(Message.objects.filter(user=self.user).values_list('role', 'content')),
+			[('user', '你好'), ('assistant', '你好呀')],
+		)
+
+
+class PrepareTurnTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='u2', password='pass12345')
+		BotSetting.objects.create(apikey='sk-test')
+
+	def test_prepare_turn_creates_conversation_and_context(self):
+		turn = prepare_turn(self.user, '你好')
+		self.assertIsNone(turn.error)
+		self.assertEqual(turn.api_key, 'sk-test')
+		self.assertEqual([m['role'] for m in turn.send_chat], ['system', 'user'])
+		self.assertEqual(turn.send_chat[-1]['content'], '你好')
+		self.assertEqual(turn.send_chat[0]['content'], DEFAULT_PROMPT)
+		finish_turn(turn, '嗯')
+		# 人设 prompt 由 PromptTemplate 引用，不再写入消息表
+		self.assertEqual(
+			Message.objects.filter(user=self.user, conversation_id=turn.conversation_id).count(), 2
+		)
+		self.assertEqual(UserSetting.objects.get(user=self.user).daily_message_count, 1)
+
+	def test_active_conversation_found_by_pk_and_counted(self):
+		first = prepare_turn(self.user, '你好')
+		finish_turn(first, '嗯')
+		with CaptureQueriesContext(connection) as ctx:
+			second = prepare_turn(self.user, '还在吗')
+		self.assertEqual(second.conversation_id, first.conversation_id)
+		self.assertFalse(any("'system'" in q['sql'] for q in ctx.captured_queries))
+		conversation = Conversation.objects.get(pk=first.conversation_id)
+		self.assertEqual(conversation.message_count, 3)
+		self.assertEqual(
+			conversation.token_total,
+			sum(Message.objects.filter(conversation_id=conversation.pk).values_list(
+				'tokens', flat=True
+			)),
+		)
+		self.assertEqual(
+			UserSetting.objects.get(user=self.user).active_conversation_id, conversation.pk
+		)
+
+	def test_persona_stored_once_and_kept_in_long_context(self):
+		other = User.objects.create_user(username='u2b', password='pass12345')
+		turn = prepare_turn(self.user, '你好')
+		prepare_turn(other, '你好')
+		self.assertEqual(PromptTemplate.objects.count(), 1)
+		self.assertEqual(
+			set(Conversation.objects.values_list('prompt_template_id', flat=True)),
+			{prompt_digest(DEFAULT_PROMPT)},
+		)
+		context = build_context(self.user, turn.conversation_id, token_limit=0, persona='人设')
+		self.assertEqual(context, [{'role': 'system', 'content': '人设'}])
+
+	def test_prepare_turn_rejects_when_daily_limit_reached(self):
+		UserSetting.objects.create(
+			user=self.user, daily_message_count=DAILY_MESSAGE_LIMIT,
+			last_message_date=timezone.now().date(),
+		)
+		turn = prepare_turn(self.user, '你好')
+		self.assertEqual(turn.error, 'daily_limit_exceeded')
+		self.assertFalse(Message.objects.filter(user=self.user).exists())
+
+
+class PersonaAdminTest(TestCase):
+	def setUp(self):
+		admin_user = User.objects.create_superuser(username='admin', password='pass12345')
+		self.client.force_login(admin_user)
+		self.user = User.objects.create_user(username='u2c', password='pass12345')
+		self.setting = UserSetting.objects.create(user=self.user)
+
+	def _post(self, prompt, prompt_jp=''):
+		return self.client.post(
+			reverse('admin:chatbot_usersetting_change', args=[self.setting.pk]),
+			{
+				'user': self.user.pk, 'modelName': 'deepseek-chat', 'generate_summary_num': 10,
+				'daily_message_count': 0, 'last_message_date': timezone.now().date().isoformat(),
+				'prompt': prompt, 'promptJP': prompt_jp,
+			},
+		)
+
+	def test_persona_round_trips_through_admin(self):
+		resp = self._post('你是一只猫。\r\n只会说喵。')
+		self.assertEqual(resp.status_code, 302)
+		setting = UserSetting.objects.get(pk=self.setting.pk)
+		self.assertEqual(setting.prompt, '你是一只猫。\n只会说喵。')
+		self.assertEqual(setting.prompt_template_id, prompt_digest('你是一只猫。\n只会说喵。'))
+		self.assertIsNone(setting.prompt_jp_template_id)
+		self.assertEqual(UserSettingForm(instance=setting)['prompt'].value(), setting.prompt)
+		# 清空后回到默认人设
+		self._post('')
+		self.assertEqual(UserSetting.objects.get(pk=setting.pk).prompt, DEFAULT_PROMPT)
+
+	def test_template_content_is_read_only_after_creation(self):
+		resp = self.client.post(reverse('admin:chatbot_prompttemplate_add'), {'content': '人设'})
+		self.assertEqual(resp.status_code, 302)
+		template = PromptTemplate.objects.get()
+		self.assertEqual(template.digest, prompt_digest('人设'))
+		self.client.post(
+			reverse('admin:chatbot_prompttemplate_change', args=[template.pk]), {'content': '改了'}
+		)
+		self.assertEqual(PromptTemplate.objects.get().content, '人设')
+
+
+class QuotaTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='u9', password='pass12345')
+		self.today = timezone.now().date()
+
+	def test_reserve_stops_at_limit_and_refunds(self):
+		UserSetting.objects.create(
+			user=self.user, daily_message_count=DAILY_MESSAGE_LIMIT - 1,
+			last_message_date=self.today,
+		)
+		with CaptureQueriesContext(connection) as ctx:
+			self.assertTrue(reserve_slot(self.user.pk))
+		self.assertEqual(len(ctx.captured_queries), 1)
+		self.assertNotIn('prompt', ctx.captured_queries[0]['sql'])
+		self.assertFalse(reserve_slot(self.user.pk))
+		self.assertTrue(refund_slot(self.user.pk))
+		self.assertEqual(
+			UserSetting.objects.get(user=self.user).daily_message_count, DAILY_MESSAGE_LIMIT - 1
+		)
+
+	def test_new_day_resets_on_reserve(self):
+		UserSetting.objects.create(
+			user=self.user, daily_message_count=DAILY_MESSAGE_LIMIT,
+			last_message_date=self.today - timezone.timedelta(days=1),
+		)
+		self.assertTrue(reserve_slot(self.user.pk))
+		us = UserSetting.objects.get(user=self.user)
+		self.assertEqual((us.daily_message_count, us.last_message_date), (1, self.today))
+		self.assertFalse(refund_slot(self.user.pk, today=self.today + timezone.timedelta(days=1)))
+
+	def test_stale_counts_reset_lazily_and_cleanup_skips_idle_rows(self):
+		yesterday = self.today - timezone.timedelta(days=1)
+		us = UserSetting.objects.create(
+			user=self.user, daily_message_count=7, last_message_date=yesterday
+		)
+		self.assertEqual(us.messages_used_today, 0)
+		idle = User.objects.create_user(username='u9-idle', password='pass12345')
+		UserSetting.objects.create(user=idle, daily_message_count=0, last_message_date=yesterday)
+		with CaptureQueriesContext(connection) as ctx:
+			self.assertEqual(clear_stale_counts(self.today, chunk_size=1), 1)
+		updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]
+		self.assertEqual(len(updates), 1)
+		self.assertEqual(UserSetting.objects.get(user=self.user).daily_message_count, 0)
+
+	def test_failed_turn_refunds_slot(self):
+		BotSetting.objects.create(apikey='sk-test')
+		turn = prepare_turn(self.user, '你好')
+		self.assertEqual(UserSetting.objects.get(user=self.user).daily_message_count, 1)
+		finish_turn(turn, '')  # 没有得到回复
+		refund_turn(turn)  # 重复退还无副作用
+		self.assertEqual(UserSetting.objects.get(user=self.user).daily_message_count, 0)
+
+
+class ClientRegistryTest(TestCase):
+	def test_lru_and_idle_eviction_are_bounded(self):
+		now = [0.0]
+		registry = ClientRegistry(
+			lambda key, url: object(), max_size=2, idle_timeout=60, clock=lambda: now[0]
+		)
+		a = registry.get('k1', None)
+		self.assertIs(registry.get('k1', None), a)
+		registry.get('k2', 'https://example.com/v1')
+		registry.get('k3', None)  # 超出容量，淘汰最久未用的 k1
+		self.assertEqual(registry.stats(), {'size': 2, 'hits': 1, 'misses': 3, 'evictions': 1})
+		now[0] = 120.0
+		registry.get('k4', None)  # k2/k3 空闲超时被淘汰
+		self.assertEqual(registry.stats()['size'], 1)
+		self.assertEqual(registry.stats()['evictions'], 3)
+
+
+class BuildContextTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='u3', password='pass12345')
+		self.conversation_id = uuid.uuid4()
+
+	def _grow_history(self, n):
+		Message.objects.bulk_create([
+			Message(
+				user=self.user, role='user' if i % 2 == 0 else 'assistant',
+				content='字' * 400, tokens=100, conversation_id=self.conversation_id,
+			)
+			for i in range(n)
+		])
+
+	def _read_context(self):
+		with CaptureQueriesContext(connection) as queries:
+			ctx = build_context(self.user, self.conversation_id, token_limit=1000)
+		self.assertEqual(len(queries), 1)
+		return ctx
+
+	def test_bytes_read_do_not_grow_with_history(self):
+		self._grow_history(20)
+		short = self._read_context()
+		self._grow_history(500)
+		long = self._read_context()
+		self.assertEqual(len(short), 10)
+		self.assertEqual(
+			sum(len(m['content'].encode()) for m in short),
+			sum(len(m['content'].encode()) for m in long),
+		)
+
+	def test_context_is_newest_suffix_in_chronological_order(self):
+		for i in range(5):
+			Message.objects.create(
+				user=self.user, role='user', content=f'm{i}', tokens=400,
+				conversation_id=self.conversation_id,
+			)
+		ctx = build_context(self.user, self.conversation_id, token_limit=1000)
+		self.assertEqual([m['content'] for m in ctx], ['m3', 'm4'])
+
+
+@override_settings(CONTEXT_CACHE_ENABLED=True)
+class ContextCacheTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='u4', password='pass12345')
+		BotSetting.objects.create(apikey='sk-test')
+		context_cache.clear()
+
+	def _turn(self, text, answer):
+		with self.captureOnCommitCallbacks(execute=True):
+			turn = prepare_turn(self.user, text)
+		with self.captureOnCommitCallbacks(execute=True):
+			finish_turn(turn, answer)
+		return turn
+
+	def test_warm_conversation_reads_only_the_version(self):
+		turn = self._turn('第一句', '回答')
+		with self.assertNumQueries(1):
+			ctx = load_context(self.user, turn.conversation_id)
+		self.assertEqual([m['content'] for m in ctx][-2:], ['第一句', '回答'])
+		self.assertEqual(ctx, build_context(self.user, turn.conversation_id))
+		hits = context_cache.stats()['hits']
+		self._turn('第二句', '回答二')
+		self.assertEqual(context_cache.stats()['hits'], hits + 1)
+		self.assertEqual(
+			load_context(self.user, turn.conversation_id),
+			build_context(self.user, turn.conversation_id),
+		)
+
+	def test_rolled_back_turn_leaves_no_phantom_message(self):
+		turn = self._turn('第一句', '回答')
+		with self.assertRaises(RuntimeError), transaction.atomic():
+			finish_turn(turn, '不会提交')
+			raise RuntimeError
+		ctx = load_context(self.user, turn.conversation_id)
+		self.assertNotIn('不会提交', [m['content'] for m in ctx])
+
+	def test_stale_seed_is_discarded_after_summary(self):
+		turn = self._turn('第一句', '回答')
+		rows = [('user', '已被摘要删除', 1)]
+		version = (None, Conversation.objects.get(pk=turn.conversation_id).message_count)
+		summary = Message.objects.create(
+			user=self.user, role='system', content='摘要', is_summary=True,
+			conversation_id=turn.conversation_id,
+		)
+		Conversation.objects.filter(pk=turn.conversation_id).update(latest_summary=summary)
+		# 摘要提交前读到的旧快照在其失效之后才写入缓存
+		context_cache.seed(turn.conversation_id, 3000, version, rows)
+		ctx = load_context(self.user, turn.conversation_id)
+		self.assertNotIn('已被摘要删除', [m['content'] for m in ctx])
+
+	def test_rolling_window_and_memory_cap(self):
+		cache = ContextCache(max_conversations=10, max_bytes=30)
+		cache.seed('a', 10, (None, 2), [('user', 'x' * 10, 4), ('assistant', 'y' * 10, 4)])
+		cache.append('a', 'user', 'z' * 10, 4)  # 超出 token 上限，最旧的一条滑出
+		self.assertEqual([m['content'][0] for m in cache.get('a', 10, (None, 3))], ['y', 'z'])
+		self.assertIsNone(cache.get('a', 10, (None, 4)))  # 版本不一致时丢弃
+		cache.seed('a', 10, (None, 2), [('user', 'x' * 10, 4), ('assistant', 'y' * 10, 4)])
+		cache.seed('b', 10, (None, 1), [('user', 'w' * 20, 1)])  # 超出字节上限，淘汰最久未用的 a
+		self.assertIsNone(cache.get('a', 10, (None, 2)))
+		self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class _FakeCompletions:
+	def __init__(self, reply):
+		self.reply = reply
+		self.calls = []
+
+	def create(self, model, messages, **kwargs):
+		self.calls.append(messages)
+		message = SimpleNamespace(content=self.reply)
+		return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def fake_client(reply):
+	return SimpleNamespace(chat=SimpleNamespace(completions=_FakeCompletions(reply)))
+
+
+@override_settings(SUMMARY_ASYNC=False)
+class BackgroundSummaryTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='u5', password='pass12345')
+		UserSetting.objects.create(user=self.user, generate_summary_num=1)
+		BotSetting.objects.create(apikey='sk-test')
+
+	def _turn(self, text):
+		turn = prepare_turn(self.user, text)
+		finish_turn(turn, f'答{text}')
+		return turn
+
+	def test_threshold_schedules_one_atomic_summary(self):
+		self._turn('一')
+		turn = self._turn('二')
+		self.assertTrue(turn.needs_summary)
+		client = fake_client('摘要')
+		with mock.patch('chatbot.summaries.get_sync_client', return_value=client):
+			self.assertTrue(schedule_summary(turn))
+			# 阈值已不再越过，重复提交不会再次调用模型
+			schedule_summary(turn)
+		self.assertEqual(len(client.chat.completions.calls), 1)
+		conv = Message.objects.filter(conversation_id=turn.conversation_id)
+		self.assertEqual(conv.filter(is_summary=True).count(), 1)
+		self.assertEqual(
+			list(conv.filter(role__in=['user', 'assistant']).values_list('content', flat=True)),
+			['二', '答二'],
+		)
+		self.assertIn('摘要', [m['content'] for m in load_context(self.user, turn.conversation_id)])
+
+	def test_incremental_summary_only_feeds_delta(self):
+		self._turn('一')
+		turn = self._turn('二')
+		with mock.patch('chatbot.summaries.get_sync_client', return_value=fake_client('摘要1')):
+			schedule_summary(turn)
+		self._turn('三')
+		turn = self._turn('四')
+		client = fake_client('摘要2')
+		with mock.patch('chatbot.summaries.get_sync_client', return_value=client):
+			schedule_summary(turn)
+		sent = [m['content'] for m in client.chat.completions.calls[0]]
+		# 上一份摘要 + 之后的新消息 + 摘要指令；已覆盖的「二」不会再次出现
+		self.assertEqual(sent[0], '此前对话的摘要：摘要1')
+		self.assertEqual(sent[1:-1], ['三', '答三', '四', '答四'])
+		summaries = Message.objects.filter(conversation_id=turn.conversation_id, is_summary=True)
+		self.assertEqual(list(summaries.values_list('content', flat=True)), ['摘要2'])
+		last = Message.objects.filter(conversation_id=turn.conversation_id, content='答四').get()
+		self.assertEqual(summaries.get().summary_covers_id, last.id)
+
+
+class DeltaCoalescerTest(TestCase):
+	def test_first_delta_immediate_then_coalesced(self):
+		frames = []
+		now = [0.0]
+
+		async def send(text):
+			frames.append(text)
+
+		async def run():
+			coalescer = DeltaCoalescer(
+				send, flush_interval=0.05, flush_bytes=9, clock=lambda: now[0]
+			)
+			for ch in '高木同学':
+				await coalescer.push(ch)
+			self.assertEqual(frames, ['高', '木同学'])  # 首字立即发送，其后攒满 9 字节
+			now[0] = 0.01
+			await coalescer.push('西')
+			self.assertEqual(len(frames), 2)
+			await coalescer.close()
+			return coalescer.frames
+
+		self.assertEqual(async_to_sync(run)(), 3)
+		self.assertEqual(''.join(frames), '高木同学西')
+
+
+class _FakeStream:
+	def __init__(self, deltas):
+		self._chunks = [
+			SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=d))])
+			for d in deltas
+		]
+
+	def __aiter__(self):
+		return self._iter()
+
+	async def _iter(self):
+		for chunk in self._chunks:
+			yield chunk
+
+
+def fake_completion(text):
+	return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+def fake_async_client(deltas=(), create=None):
+	"""上游替身：流式请求逐段返回 deltas，非流式返回整段回复；也可传入自定义的 create。"""
+	if create is None:
+		async def create(model, messages, stream=False, **kwargs):
+			return _FakeStream(deltas) if stream else fake_completion(''.join(deltas))
+	return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+class ChatStreamViewTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='u6', password='pass12345')
+		BotSetting.objects.create(apikey='sk-test')
+		self.client.login(username='u6', password='pass12345')
+
+	def _events(self, resp):
+		async def collect(content):
+			return b''.join([chunk async for chunk in content])
+		body = async_to_sync(collect)(resp.streaming_content).decode()
+		return [json.loads(line[6:]) for line in body.split('\n') if line.startswith('data: ')]
+
+	def test_streams_same_events_as_websocket(self):
+		client = fake_async_client(['你', '好'])
+		with mock.patch('chatbot.streaming.get_async_client', return_value=client):
+			resp = self.client.post(reverse('chat_stream'), {'message': '在吗'})
+			events = self._events(resp)
+		self.assertEqual(resp['Content-Type'], 'text/event-stream; charset=utf-8')
+		self.assertEqual(''.join(e.get('delta', '') for e in events), '你好')
+		self.assertEqual(events[-1], {'done': True})
+		self.assertTrue(
+			Message.objects.filter(user=self.user, role='assistant', content='你好').exists()
+		)
+
+	def test_rejects_get_and_empty_message(self):
+		self.assertEqual(self.client.get(reverse('chat_stream')).status_code, 405)
+		resp = self.client.post(reverse('chat_stream'), {'message': ' '})
+		self.assertEqual(self._events(resp), [{'error': 'empty_message'}])
+
+
+class ResponseCacheTest(TestCase):
+	_events = ChatStreamViewTest._events
+
+	def test_variants_ttl_and_lru(self):
+		now = [0.0]
+		cache = ResponseCache(
+			max_entries=2, ttl=10, variants=2, clock=lambda: now[0], choice=lambda v: v[-1]
+		)
+		self.assertEqual(normalize_input('  你好！！'), normalize_input('你好'))
+		cache.put('a', '嗨')
+		self.assertIsNone(cache.get('a'))  # 候选未攒满
+		cache.put('a', '嗨')  # 重复回复不计入
+		cache.put('a', '你好呀')
+		self.assertEqual(cache.get('a'), '你好呀')
+		cache.put('b', 'x')
+		cache.put('c', 'y')  # 淘汰最久未用的 a
+		self.assertIsNone(cache.get('a'))
+		cache.put('b', 'z')
+		now[0] = 11
+		self.assertIsNone(cache.get('b'))  # 已过期
+		stats = cache.stats()
+		self.assertEqual((stats['hits'], stats['evictions'], stats['expirations']), (1, 1, 1))
+		self.assertEqual(stats['hit_rate'], 0.25)
+
+	@override_settings(RESPONSE_CACHE_ENABLED=True)
+	def test_second_greeting_streams_from_cache(self):
+		BotSetting.objects.create(apikey='sk-test')
+		users = [
+			User.objects.create_user(username=f'rc{i}', password='pass12345') for i in range(2)
+		]
+		calls = []
+
+		async def create(model, messages, **kwargs):
+			calls.append(messages)
+			return _FakeStream(['你好，', '今天想聊什么？'])
+
+		client = fake_async_client(create=create)
+
+		def chat(user, text):
+			self.client.force_login(user)
+			resp = self.client.post(reverse('chat_stream'), {'message': text})
+			return self._events(resp)
+
+		response_cache.clear()
+		with mock.patch.object(response_cache, 'variants', 1), \
+				mock.patch('chatbot.streaming.get_async_client', return_value=client):
+			chat(users[0], '你好')
+			events = chat(users[1], '你好！')
+			chat(users[0], '你好')  # 已不是首轮，照常调用上游
+		response_cache.clear()
+		self.assertEqual(len(calls), 2)
+		self.assertEqual(''.join(e.get('delta', '') for e in events), '你好，今天想聊什么？')
+		self.assertEqual(events[-1], {'done': True})
+		self.assertTrue(
+			Message.objects.filter(
+				user=users[1], role='assistant', content='你好，今天想聊什么？'
+			).exists()
+		)
+
+
+class WikiRetrievalTest(TestCase):
+	def test_bigram_bm25_ranks_matching_fact_first(self):
+		self.assertEqual(tokenize('西片讨厌 Coffee'), ['西片', '片讨', '讨厌', 'coffee'])
+		facts = flatten_facts(
+			{'数据来源': 'x', '西片': {'讨厌': ['青椒', '苦味'], '兴趣': ['撸猫']}}
+		)
+		self.assertEqual(facts, ['西片·讨厌：青椒、苦味', '西片·兴趣：撸猫'])
+		index = WikiIndex(facts + ['高木·讨厌：能量饮料'])
+		self.assertEqual(index.search('西片讨厌什么？', 1), ['西片·讨厌：青椒、苦味'])
+		self.assertEqual(index.search('你好', 3), [])
+
+	@override_settings(WIKI_RETRIEVAL_ENABLED=True, WIKI_RETRIEVAL_TOP_K=2)
+	def test_default_persona_replaced_by_core_prompt_and_facts(self):
+		user = User.objects.create_user(username='wiki1', password='pass12345')
+		BotSetting.objects.create(apikey='sk-test')
+		turn = prepare_turn(user, '西片讨厌吃什么？')
+		persona = turn.send_chat[0]['content']
+		self.assertTrue(persona.startswith(CORE_PROMPT))
+		self.assertIn('青椒', persona)
+		self.assertLess(len(persona), len(DEFAULT_PROMPT) / 2)
+		# 会话中存的仍是默认人设，关闭检索即可恢复
+		conversation = Conversation.objects.get(pk=turn.conversation_id)
+		self.assertEqual(conversation.prompt_template_id, prompt_digest(DEFAULT_PROMPT))
+
+
+class MockOpenAITest(TestCase):
+	def _client(self, app):
+		http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app))
+		return AsyncOpenAI(
+			api_key='sk-mock', base_url='http://mock/v1', http_client=http_client, max_retries=0
+		)
+
+	def test_streams_tokens_and_reports_missing_model(self):
+		app = MockOpenAI(token_rate=1000, first_token_latency=0, reply_tokens=5)
+
+		async def run():
+			client = self._client(app)
+			stream = await client.chat.completions.create(
+				model='deepseek-chat', messages=[{'role': 'user', 'content': '你好'}], stream=True
+			)
+			text = ''.join([chunk.choices[0].delta.content or '' async for chunk in stream])
+			with self.assertRaises(BadRequestError) as missing:
+				await client.chat.completions.create(model='no-such-model', messages=[])
+			return text, missing.exception
+
+		text, error = async_to_sync(run)()
+		self.assertEqual(len(text), 5)
+		self.assertTrue(is_model_missing(error))
+
+	def test_injects_errors(self):
+		app = MockOpenAI(first_token_latency=0, error_rate=1.0, error_status=503)
+
+		async def run():
+			with self.assertRaises(APIStatusError) as failure:
+				await self._client(app).chat.completions.create(model='deepseek-chat', messages=[])
+			return failure.exception.status_code
+
+		self.assertEqual(async_to_sync(run)(), 503)
+		self.assertEqual((app.requests, app.errors), (1, 1))
+
+
+@override_settings(METRICS_ENABLED=True, METRICS_TOKEN='secret')
+class MetricsTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='m1', password='pass12345')
+		BotSetting.objects.create(apikey='sk-test')
+		self.client.login(username='m1', password='pass12345')
+		# 测试连接建立时指标尚未开启，手动挂上查询计数
+		install_query_counter(None, connection)
+		self.addCleanup(connection.execute_wrappers.remove, count_query)
+
+	def test_stream_turn_phases_exposed_on_metrics(self):
+		client = fake_async_client(['你', '好'])
+		with mock.patch('chatbot.streaming.get_async_client', return_value=client):
+			resp = self.client.post(reverse('chat_stream'), {'message': '在吗'})
+			ChatStreamViewTest._events(self, resp)
+		body = self.client.get(
+			reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret'
+		).content.decode()
+		labels = 'model="deepseek-chat",key_source="shared"'
+		phases = (
+			'thread_wait', 'db_prepare', 'queue', 'upstream_ttft', 'stream', 'persist', 'total'
+		)
+		for phase in phases:
+			self.assertIn(f'chat_turn_phase_seconds_count{{phase="{phase}",{labels}}}', body)
+		self.assertRegex(body, rf'chat_turns_total{{{labels},outcome="ok"}} \d+')
+		self.assertRegex(body, r'chat_db_queries_total{phase="db_prepare"} [1-9]')
+		self.assertIn(f'chat_turn_frames_bucket{{{labels},le="+Inf"}}', body)
+
+	def test_token_required_when_configured(self):
+		self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+		resp = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+		self.assertEqual(resp.status_code, 200)
+
+	def test_loopback_is_not_authentication(self):
+		# 测试客户端的 REMOTE_ADDR 为 127.0.0.1
+		with override_settings(METRICS_TOKEN=''):
+			self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+		with override_settings(METRICS_ENABLED=False):
+			resp = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+			self.assertEqual(resp.status_code, 404)
+
+
+class DatabaseConfigTest(TestCase):
+	def test_parse_database_url(self):
+		base = Path('/srv/app')
+		relative = parse_database_url('sqlite:///db.sqlite3', base)
+		self.assertEqual(relative['NAME'], base / 'db.sqlite3')
+		absolute = parse_database_url('sqlite:////data/chat.db', base)
+		self.assertEqual(absolute['NAME'], '/data/chat.db')
+		url = (
+			'postgres://chat:p%40ss@%2Fvar%2Frun%2Fpostgresql:5433/chat'
+			'?sslmode=require&connect_timeout=5'
+		)
+		db = parse_database_url(url, base)
+		self.assertEqual(
+			(db['ENGINE'], db['NAME'], db['USER'], db['PASSWORD'], db['HOST'], db['PORT']),
+			(
+				'django.db.backends.postgresql', 'chat', 'chat', 'p@ss',
+				'/var/run/postgresql', '5433',
+			),
+		)
+		self.assertEqual(db['OPTIONS'], {'sslmode': 'require', 'connect_timeout': 5})
+		with self.assertRaises(ImproperlyConfigured):
+			parse_database_url('mysql://localhost/chat', base)
+
+	def test_asgi_request_threads_close_their_persistent_connections(self):
+		persistent = mock.Mock(settings_dict={'CONN_MAX_AGE': 600})
+		per_request = mock.Mock(settings_dict={'CONN_MAX_AGE': 0})
+		unopened = mock.Mock(settings_dict={'CONN_MAX_AGE': 600}, connection=None)
+		with mock.patch('chatbot.db_connections.connections') as connections:
+			connections.all.return_value = [persistent, per_request, unopened]
+			close_request_connections(WSGIHandler)
+			connections.all.assert_not_called()
+			close_request_connections(ASGIHandler)
+		persistent.close.assert_called_once()
+		per_request.close.assert_not_called()
+		unopened.close.assert_not_called()
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite 后端专用')
+class SqliteBackendTest(TestCase):
+	def test_pragmas_and_immediate_transactions_on_new_connections(self):
+		tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(tmp.cleanup)
+		settings_dict = dict(connection.settings_dict, NAME=os.path.join(tmp.name, 'bench.sqlite3'))
+		settings_dict['OPTIONS'] = {
+			'timeout': 2, 'transaction_mode': 'IMMEDIATE',
+			'pragmas': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'temp_store': 'MEMORY'},
+		}
+		wrapper = SqliteDatabaseWrapper(settings_dict, 'bench')
+		self.addCleanup(wrapper.close)
+		with wrapper.cursor() as cursor:
+			self.assertEqual(cursor.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+			self.assertEqual(cursor.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+			self.assertEqual(cursor.execute('PRAGMA busy_timeout').fetchone()[0], 2000)
+		with CaptureQueriesContext(wrapper) as ctx:
+			wrapper._start_transaction_under_autocommit()  # transaction.atomic() 开启事务的入口
+			wrapper.cursor().execute('ROLLBACK')
+		self.assertEqual(ctx.captured_queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+
+class ProfilingTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='p1', password='pass12345')
+		self.client.login(username='p1', password='pass12345')
+		self.tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmp.cleanup)
+
+	def _profiles(self):
+		return sorted(os.listdir(self.tmp.name))
+
+	def _settings(self, **extra):
+		return override_settings(PROFILING_ENABLED=True, PROFILING_DIR=self.tmp.name, **extra)
+
+	def test_header_triggers_profile_with_metadata(self):
+		with self._settings():
+			# 未设置 PROFILING_TOKEN 时请求头不触发
+			self.client.get(reverse('get_chat_history'), HTTP_X_PROFILE='1')
+			self.assertEqual(self._profiles(), [])
+		with self._settings(PROFILING_TOKEN='secret'):
+			self.client.get(reverse('get_chat_history'), HTTP_X_PROFILE='1')
+			self.assertEqual(self._profiles(), [])
+			self.client.get(reverse('get_chat_history'), HTTP_X_PROFILE='secret')
+		files = self._profiles()
+		self.assertEqual([f.rsplit('.', 1)[1] for f in files], ['json', 'prof'])
+		with open(os.path.join(self.tmp.name, files[0]), encoding='utf-8') as f:
+			meta = json.load(f)
+		self.assertEqual(
+			(meta['name'], meta['trigger'], meta['user'], meta['status']),
+			('get_chat_history', 'header', 'p1', 200),
+		)
+
+	def test_user_trigger_on_async_view_and_aggregate(self):
+		client = fake_async_client(['好的'])
+		BotSetting.objects.create(apikey='sk-test')
+		with self._settings(PROFILING_USERS='someone, p1', PROFILING_MAX_FILES=1), \
+				mock.patch('chatbot.views.get_async_client', return_value=client):
+			self.client.post(reverse('chatbot'), {'message': '你好'})
+			self.client.post(reverse('chatbot'), {'message': '在吗'})
+			self.assertEqual(len(self._profiles()), 2)  # 只保留最新一份
+			out = io.StringIO()
+			call_command('profiles', 'aggregate', '--name', 'chatbot', stdout=out)
+		self.assertIn('汇总 1 份', out.getvalue())
+		self.assertIn('function calls', out.getvalue())
+
+	def test_disabled_by_default(self):
+		with override_settings(PROFILING_DIR=self.tmp.name):
+			self.client.get(reverse('get_chat_history'), HTTP_X_PROFILE='1')
+		self.assertEqual(self._profiles(), [])
+
+
+class _StalledStream:
+	"""发出一个增量后停住，模拟仍在生成的上游。"""
+
+	def __init__(self):
+		self.closed = False
+
+	def __aiter__(self):
+		return self._iter()
+
+	async def _iter(self):
+		yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content='我在'))])
+		await asyncio.Event().wait()
+
+	async def close(self):
+		self.closed = True
+
+
+class StopGenerationTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='u8', password='pass12345')
+		BotSetting.objects.create(apikey='sk-test')
+
+	def test_stop_closes_upstream_and_saves_partial(self):
+		stream = _StalledStream()
+
+		async def create(model, messages, **kwargs):
+			return stream
+
+		client = fake_async_client(create=create)
+
+		async def run():
+			communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/ws/chat/')
+			communicator.scope['user'] = self.user
+			await communicator.connect()
+			await communicator.receive_json_from()  # welcome
+			await communicator.send_json_to({'message': '在吗'})
+			first = await communicator.receive_json_from()
+			await communicator.send_json_to({'message': '还有'})
+			busy = await communicator.receive_json_from()
+			await communicator.send_json_to({'type': 'stop'})
+			stopped = await communicator.receive_json_from()
+			await communicator.disconnect()
+			return first, busy, stopped
+
+		with mock.patch('chatbot.streaming.get_async_client', return_value=client):
+			first, busy, stopped = async_to_sync(run)()
+		self.assertEqual(first, {'delta': '我在'})
+		self.assertEqual(busy, {'error': 'busy'})
+		self.assertEqual(stopped, {'done': True, 'truncated': True})
+		self.assertTrue(stream.closed)
+		reply = Message.objects.get(user=self.user, role='assistant')
+		self.assertEqual((reply.content, reply.truncated), ('我在', True))
+		self.assertFalse(Message.objects.filter(content='还有').exists())
+
+
+class AdmissionControllerTest(TestCase):
+	def test_limits_per_user_and_per_pool(self):
+		controller = AdmissionController(
+			global_limit=3, per_user_limit=1, pool_limits={SHARED_POOL: 1, OWN_KEY_POOL: 2}
+		)
+
+		async def run():
+			a = await controller.acquire(1)
+			with self.assertRaises(AdmissionTimeout):
+				await controller.acquire(2, timeout=0.01)  # 共享池已满
+			b = await controller.acquire(2, OWN_KEY_POOL)  # 自带 Key 的池不受影响
+			with self.assertRaises(AdmissionTimeout):
+				await controller.acquire(2, OWN_KEY_POOL, timeout=0.01)  # 每用户上限
+			controller.release(a)
+			controller.release(b)
+			return controller.stats()
+
+		stats = async_to_sync(run)()
+		self.assertEqual((stats['active'], stats['waiting'], stats['timeouts']), (0, 0, 2))
+
+	def test_light_user_overtakes_heavy_burst(self):
+		controller = AdmissionController(
+			global_limit=1, per_user_limit=5, pool_limits={SHARED_POOL: 1}
+		)
+		order = []
+		positions = []
+
+		async def run():
+			first = await controller.acquire('heavy')
+
+			async def request(user_id, on_position=None):
+				ticket = await controller.acquire(user_id, on_position=on_position)
+				order.append(user_id)
+				await asyncio.sleep(0)
+				controller.release(ticket)
+
+			async def report(position):
+				positions.append(position)
+
+			tasks = [asyncio.ensure_future(request('heavy')) for _ in range(3)]
+			await asyncio.sleep(0)
+			tasks.append(asyncio.ensure_future(request('light', report)))
+			await asyncio.sleep(0)
+			controller.release(first)
+			await asyncio.gather(*tasks)
+
+		async_to_sync(run)()
+		self.assertEqual(order, ['light', 'heavy', 'heavy', 'heavy'])
+		self.assertEqual(positions, [1])
+
+
+class ChatHistoryCursorTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='u10', password='pass12345')
+		self.client.login(username='u10', password='pass12345')
+		self.conv = uuid.uuid4()
+		for i in range(5):
+			Message.objects.create(
+				user=self.user, role='user' if i % 2 == 0 else 'assistant', content=f'm{i}',
+				conversation_id=self.conv,
+			)
+		Message.objects.create(user=self.user, role='user', content='other')
+
+	def test_walks_pages_with_cursor(self):
+		seen = []
+		params = {'before': '', 'conversation_id': str(self.conv), 'per_page': 2}
+		while True:
+			with CaptureQueriesContext(connection) as ctx:
+				data = self.client.get(reverse('get_chat_history'), params).json()
+			self.assertFalse(any('COUNT(' in q['sql'] for q in ctx.captured_queries))
+			seen = [m['content'] for m in data['messages']] + seen
+			if not data['next_cursor']:
+				break
+			params['before'] = data['next_cursor']
+		self.assertEqual(seen, ['m0', 'm1', 'm2', 'm3', 'm4'])
+
+	@override_settings(
+		CHAT_HISTORY_RENDER_TURNS=2,
+		STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+	)
+	def test_page_renders_recent_turns_and_cursor(self):
+		resp = self.client.get(reverse('chatbot'))
+		pairs = resp.context['chat_pairs']
+		self.assertEqual([p['user_message'].content for p in pairs], ['m2'])
+		data = self.client.get(
+			reverse('get_chat_history'), {'before': resp.context['history_cursor']}
+		).json()
+		self.assertEqual([m['content'] for m in data['messages']], ['m0', 'm1'])
+
+	def test_unchanged_page_returns_304_until_new_message(self):
+		params = {'before': '', 'conversation_id': str(self.conv)}
+		resp = self.client.get(reverse('get_chat_history'), params)
+		etag = resp['ETag']
+		self.assertEqual(
+			self.client.get(
+				reverse('get_chat_history'), params, HTTP_IF_NONE_MATCH=etag
+			).status_code,
+			304,
+		)
+		Message.objects.create(
+			user=self.user, role='assistant', content='m5', conversation_id=self.conv
+		)
+		resp = self.client.get(reverse('get_chat_history'), params, HTTP_IF_NONE_MATCH=etag)
 		self.assertEqual(resp.status_code, 200)
-		self.assertTrue(Chat.objects.filter(user=self.user, message='你好').exists())
-		self.assertTrue(Message.objects.filter(user=self.user, role='user', content='你好').exists())
+		self.assertNotEqual(resp['ETag'], etag)
+
+	@override_settings(JSON_COMPRESSION_MIN_BYTES=200)
+	def test_large_json_is_gzipped(self):
+		Message.objects.create(
+			user=self.user, role='assistant', content='高木同学' * 200, conversation_id=self.conv
+		)
+		params = {'before': '', 'conversation_id': str(self.conv)}
+		resp = self.client.get(reverse('get_chat_history'), params, HTTP_ACCEPT_ENCODING='gzip')
+		self.assertEqual(resp['Content-Encoding'], 'gzip')
+		self.assertTrue(resp['ETag'].startswith('W/'))
+		data = json.loads(gzip.decompress(resp.content))
+		self.assertEqual(data['messages'][-1]['content'], '高木同学' * 200)
+
+	def test_caps_per_page_and_rejects_bad_cursor(self):
+		data = self.client.get(
+			reverse('get_chat_history'), {'before': '', 'per_page': 10000, 'include_total': 1}
+		).json()
+		self.assertEqual((data['per_page'], data['total_messages']), (100, 6))
+		resp = self.client.get(reverse('get_chat_history'), {'before': 'nonsense'})
+		self.assertEqual(resp.status_code, 400)
+
+
+class AsyncChatbotViewTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='u7', password='pass12345')
+		UserSetting.objects.create(user=self.user, modelName='no-such-model')
+		BotSetting.objects.create(apikey='sk-test')
+		self.client.login(username='u7', password='pass12345')
+
+	def test_post_falls_back_when_model_missing(self):
+		models = []
+
+		async def create(model, messages, **kwargs):
+			models.append(model)
+			if model == 'no-such-model':
+				request = httpx.Request('POST', 'http://upstream/v1/chat/completions')
+				raise BadRequestError(
+					'The model does not exist', response=httpx.Response(400, request=request),
+					body=None,
+				)
+			return fake_completion('好的')
+
+		client = fake_async_client(create=create)
+		with mock.patch('chatbot.views.get_async_client', return_value=client):
+			resp = self.client.post(reverse('chatbot'), {'message': '你好'})
+		self.assertEqual(resp.json()['response'], '好的')
+		self.assertEqual(models, ['no-such-model', fallback_model('no-such-model')])
+		self.assertTrue(
+			Message.objects.filter(user=self.user, role='assistant', content='好的').exists()
+		)
@@ -0,0 +1,144 @@
+"""对话回合的数据库准备与收尾。
+
+WebSocket 与 HTTP 两条聊天路径共用：每个回合的所有 ORM 读写集中在
+``prepare_turn`` / ``finish_turn`` 两个同步函数中，各自在一个事务内完成，
+异步调用方只需一次 ``database_sync_to_async`` 线程跳转。
+"""
+
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+
+from .context import load_context, remember_message
+from .conversations import (
+    active_conversation_id,
+    conversation_prompt_digest,
+    record_message,
+    unsummarized_count,
+)
+from .models import BotSetting, Message, UserSetting
+from .openai_clients import default_model_name
+from .prompts import prompt_text
+from .quota import refund_slot, reserve_slot
+from .response_cache import first_turn_key
+from .retrieval import persona_for_turn
+from .summaries import summary_threshold
+
+DEFAULT_SUMMARY_CMD = "请总结我们的对话，要求不能超过200字"
+
+
+@dataclass
+class TurnContext:
+    """prepare_turn 的结果：上下文、调用凭据与额度状态。"""
+
+    user: object
+    user_setting: UserSetting
+    error: Optional[str] = None
+    api_key: Optional[str] = None
+    base_url: Optional[str] = None
+    model_name: str = ''
+    summary_cmd: str = DEFAULT_SUMMARY_CMD
+    conversation_id: Optional[object] = None
+    send_chat: List[dict] = field(default_factory=list)
+    quota_limited: bool = False  # 本回合是否占用了每日额度的一个名额
+    needs_summary: bool = False
+    cache_key: Optional[tuple] = None  # 可缓存的首轮消息的回复缓存键
+    # 各阶段耗时（秒），回合结束时由 metrics.record_turn 写入直方图
+    spans: Dict[str, float] = field(default_factory=dict)
+    started_at: float = field(default_factory=time.perf_counter)
+
+
+def resolve_credentials(user_setting, bot_setting):
+    """按 用户自定义 > BotSetting > 环境变量 的顺序解析 (api_key, base_url)。"""
+    if user_setting.user_api_key:
+        api_key = user_setting.user_api_key.strip()
+    elif bot_setting and bot_setting.apikey:
+        api_key = bot_setting.apikey
+    else:
+        api_key = getattr(settings, 'OPENAI_API_KEY', None) or os.getenv('OPENAI_API_KEY')
+    base_url = getattr(settings, 'OPENAI_BASE_URL', None)
+    if user_setting.user_base_url:
+        base_url = user_setting.user_base_url.strip()
+    return api_key, base_url or None
+
+
+def is_quota_limited(user, user_setting) -> bool:
+    return not user.is_superuser and not user_setting.user_api_key
+
+
+def prepare_turn(user, user_input: str, *, enforce_quota: bool = True) -> TurnContext:
+    """在一个事务内完成一个回合开始前的全部数据库工作。
+
+    依次：获取/创建 UserSetting、读取 BotSetting 解析凭据、占用当日额度名额、
+    按主键定位（必要时创建）当前会话、写入用户消息并更新会话计数、构造上下文。
+    出错时 ``error`` 非空，且不会写入任何消息或占用额度。
+    """
+    started = time.perf_counter()
+    with transaction.atomic():
+        user_setting, _ = UserSetting.objects.get_or_create(user=user)
+        turn = TurnContext(user=user, user_setting=user_setting, started_at=started)
+
+        bot_setting = BotSetting.objects.first()
+        turn.api_key, turn.base_url = resolve_credentials(user_setting, bot_setting)
+        if bot_setting:
+            turn.summary_cmd = bot_setting.summary_cmd
+        if not turn.api_key:
+            turn.error = 'no_api_key'
+            return turn
+
+        if enforce_quota and is_quota_limited(user, user_setting):
+            # 检查与占用在同一条条件 UPDATE 中完成；回合失败时由 refund_turn 退还
+            if not reserve_slot(user.pk):
+                turn.error = 'daily_limit_exceeded'
+                return turn
+            turn.quota_limited = True
+        turn.model_name = (user_setting.modelName or default_model_name()).strip()
+
+        # 当前会话按主键取得；尚无会话时新建
+        turn.conversation_id = active_conversation_id(user, user_setting)
+
+        user_msg = Message.objects.create(
+            user=user, role='user', content=user_input, conversation_id=turn.conversation_id
+        )
+        record_message(user_msg)
+        digest = conversation_prompt_digest(turn.conversation_id)
+        persona = persona_for_turn(digest, prompt_text(digest) if digest else None, user_input)
+        # 用户消息在提交后才进入上下文缓存
+        turn.send_chat = load_context(
+            user, turn.conversation_id, persona=persona, pending=user_msg
+        )
+        turn.cache_key = first_turn_key(turn, digest)
+    return turn
+
+
+def finish_turn(turn: TurnContext, answer: str, *, truncated: bool = False):
+    """在一个事务内保存助手回复并判断是否需要摘要。answer 为空时不写入并退还额度。
+
+    truncated=True 表示生成被中途取消，保存的是已生成的部分。
+    """
+    if not answer:
+        refund_turn(turn)
+        return None
+    with transaction.atomic():
+        msg = Message.objects.create(
+            user=turn.user, role='assistant', content=answer,
+            conversation_id=turn.conversation_id, truncated=truncated,
+        )
+        record_message(msg)
+        remember_message(msg)
+        turn.needs_summary = (
+            unsummarized_count(turn.user.pk, turn.conversation_id)
+            > summary_threshold(turn.user_setting)
+        )
+    return msg
+
+
+def refund_turn(turn: TurnContext):
+    """回合没有得到回复时退还 prepare_turn 占用的额度名额，重复调用无副作用。"""
+    if turn.quota_limited:
+        turn.quota_limited = False
+        refund_slot(turn.user.pk)
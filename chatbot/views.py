@@ -1,175 +1,217 @@
-from django.shortcuts import render, redirect
-from django.http import JsonResponse, HttpResponseBadRequest
-from openai import OpenAI, BadRequestError
+import hashlib
+import random
+import string
+import time
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
-import os
 from django.contrib import auth
-from django.contrib.auth.models import User
-from .models import Chat, UserSetting, BotSetting, Message
-from django.utils import timezone
+from django.contrib.auth import update_session_auth_hash
 from django.contrib.auth.decorators import login_required
-from django.views.decorators.http import require_POST
-from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.contrib.auth.models import User
+from django.contrib.auth.password_validation import validate_password
+from django.contrib.sites.shortcuts import get_current_site
 from django.core.cache import cache
-from django.core.mail import send_mail, EmailMultiAlternatives
+from django.core.exceptions import ValidationError
+from django.core.mail import EmailMultiAlternatives, send_mail
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    HttpResponseNotAllowed,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.shortcuts import redirect, render
 from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import constant_time_compare
 from django.utils.html import strip_tags
-from django.contrib.sites.shortcuts import get_current_site
-from django.contrib.auth.password_validation import validate_password
-from django.core.exceptions import ValidationError
-from django.contrib.auth import update_session_auth_hash
-import random
-import string
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_POST
+from openai import BadRequestError
+
+from .admission import AdmissionTimeout, admission, admission_pool
+from .history import (
+    BadCursor,
+    clamp_per_page,
+    decode_cursor,
+    encode_cursor,
+    history_page,
+    history_queryset,
+    parse_conversation_id,
+    serialize_message,
+)
+from .metrics import record_turn, timed_sync
+from .metrics import render as render_metrics
+from .models import UserSetting
+from .openai_clients import fallback_model, get_async_client, is_model_missing
+from .profiling import profiled
+from .response_cache import response_cache
+from .streaming import sse_events, sse_format, turn_error_event
+from .summaries import schedule_summary
+from .templatetags.avatar_extras import cravatar
+from .turns import finish_turn, prepare_turn
 
 #生成摘要的命令
 summary_cmd = ""
 
-# 系统运行时所有用户的会话
-def ask_openai(user_message: str, request):
-    """使用数据库中持久化的 Message 构造上下文并调用 OpenAI。"""
-    user = request.user
+MODEL_SWITCH_NOTE = "(注意: 原模型不可用，已自动切换为 {model})"
 
-    # 获取 / 初始化用户设置
-    user_setting, _ = UserSetting.objects.get_or_create(user=user)
+# 用户设置表单可修改的字段
+SETTINGS_FIELDS = ['modelName', 'user_api_key', 'user_base_url', 'avatar_url']
 
-    # 读取 BotSetting & API Key
-    api_key = None
-    base_url = getattr(settings, 'OPENAI_BASE_URL', None)
-    bot_setting = BotSetting.objects.first()
-    # 用户自定义优先
-    if user_setting.user_api_key:
-        api_key = user_setting.user_api_key.strip()
-    elif bot_setting and bot_setting.apikey:
-        api_key = bot_setting.apikey
-    else:
-        api_key = getattr(settings, 'OPENAI_API_KEY', None) or os.getenv('OPENAI_API_KEY')
 
-    summary_cmd_local = bot_setting.summary_cmd if bot_setting else "请总结我们的对话，要求不能超过200字"
+def _remember_reply(turn, model_name, answer):
+    # 切换过模型的回复不对应缓存键中的模型，不缓存
+    if turn.cache_key and model_name == turn.model_name:
+        response_cache.put(turn.cache_key, answer)
 
-    # base_url 也允许用户覆盖
-    if user_setting.user_base_url:
-        base_url = user_setting.user_base_url.strip()
-    if not api_key:
+
+async def aask_openai(user_message: str, request):
+    """调用模型回复一条消息：等待模型期间不占用线程，仅准备/收尾回合时各跳转一次线程。"""
+    turn, wait, elapsed = await timed_sync(
+        'db_prepare', prepare_turn, request.user, user_message, enforce_quota=False
+    )
+    turn.spans.update(thread_wait=wait, db_prepare=elapsed)
+    if turn.error == 'no_api_key':
+        record_turn(turn, turn.error)
         return "OpenAI API Key 未配置，请联系管理员或在 .env 中设置 OPENAI_API_KEY。"
 
-    client = OpenAI(api_key=api_key, base_url=base_url or None)
-
-    # 若还没有任何系统提示，为本会话插入一条 system prompt（后续支持多会话时需传 conversation_id）
-    conversation_id = None
-    first_system = Message.objects.filter(user=user, role='system').order_by('created_at').first()
-    if first_system:
-        conversation_id = first_system.conversation_id
-    if not conversation_id:
-        # 创建系统消息
-        system_msg = Message.objects.create(user=user, role='system', content=user_setting.prompt, is_summary=False)
-        conversation_id = system_msg.conversation_id
-
-    # 写入当前用户输入
-    user_msg_obj = Message.objects.create(user=user, role='user', content=user_message, conversation_id=conversation_id)
-
-    # 统计当前会话消息，按时间升序
-    qs = Message.objects.filter(user=user, conversation_id=conversation_id).order_by('-created_at')
-
-    token_limit = getattr(settings, 'TOKEN_CONTEXT_LIMIT', 3000)
-    accumulated = 0
-    context_messages = []
-    for m in qs:
-        accumulated += (m.tokens or 0)
-        if accumulated > token_limit:
-            break
-        context_messages.append(m)
-    context_messages.reverse()  # 还原时间顺序
-
-    sendChat = [
-        {"role": m.role, "content": m.content} for m in context_messages
-    ]
-
-    # 检查是否需要摘要：用户消息数量（非系统/摘要）超过 generate_summary_num*2
-    non_summary_pairs = Message.objects.filter(user=user, conversation_id=conversation_id, role__in=['user','assistant'], is_summary=False).count()
-    if non_summary_pairs > user_setting.generate_summary_num * 2:
-        summary_text = generate_summary(user, conversation_id, summary_cmd_local, client, sendChat, user_setting)
-        if summary_text:
-            # 删除旧的非摘要对话（保留最近两轮以免摘要突兀）
-            old_msgs = Message.objects.filter(user=user, conversation_id=conversation_id, role__in=['user','assistant'], is_summary=False).order_by('-created_at')[2:]
-            # 为避免直接 delete 误删最近，需要取除去前2条之后的剩余
-            ids_to_delete = list(old_msgs.values_list('id', flat=True))
-            if ids_to_delete:
-                Message.objects.filter(id__in=ids_to_delete).delete()
-            Message.objects.create(user=user, role='system', content=summary_text, is_summary=True, conversation_id=conversation_id)
-            # 重新构建上下文
-            qs2 = Message.objects.filter(user=user, conversation_id=conversation_id).order_by('-created_at')
-            accumulated = 0
-            context_messages = []
-            for m in qs2:
-                accumulated += (m.tokens or 0)
-                if accumulated > token_limit:
-                    break
-                context_messages.append(m)
-            context_messages.reverse()
-            sendChat = [{"role": m.role, "content": m.content} for m in context_messages]
-
-    configured_default = getattr(settings, 'OPENAI_DEFAULT_MODEL', 'gpt-3.5-turbo')
-    model_name = (user_setting.modelName or configured_default).strip()
-
-    def _invoke(model: str):
-        return client.chat.completions.create(model=model, messages=sendChat)
+    cached = response_cache.get(turn.cache_key) if turn.cache_key else None
+    if cached is not None:
+        _, _, turn.spans['persist'] = await timed_sync('persist', finish_turn, turn, cached)
+        record_turn(turn, 'cached')
+        return cached
+
+    client = get_async_client(turn.api_key, turn.base_url)
+    sendChat = turn.send_chat
+    model_name = turn.model_name
 
     tried_fallback = False
-    while True:
-        try:
-            response = _invoke(model_name)
-            answer = response.choices[0].message.content.strip()
-            Message.objects.create(user=user, role='assistant', content=answer, conversation_id=conversation_id)
-            return answer
-        except BadRequestError as e:
-            if (not tried_fallback) and ('model' in str(e).lower() and 'exist' in str(e).lower()):
-                tried_fallback = True
-                fallback_model = configured_default
-                if model_name == fallback_model:
-                    fallback_model = 'gpt-3.5-turbo'
-                model_name = fallback_model
-                sendChat.append({"role": "system", "content": f"(注意: 原模型不可用，已自动切换为 {model_name})"})
-                continue
-            return f"模型调用失败：{e}. 请确认模型名称已在服务端启用。"
-        except Exception as e:  # 广泛捕获防止 500 直接暴露
-            return f"调用出错：{e}"
+    outcome = 'error'
+    try:
+        while True:
+            try:
+                queued_at = time.perf_counter()
+                async with admission.slot(request.user.pk, admission_pool(turn)):
+                    requested_at = time.perf_counter()
+                    turn.spans['queue'] = turn.spans.get('queue', 0.0) + requested_at - queued_at
+                    response = await client.chat.completions.create(
+                        model=model_name, messages=sendChat
+                    )
+                    turn.spans['upstream'] = time.perf_counter() - requested_at
+                answer = response.choices[0].message.content.strip()
+                _, _, turn.spans['persist'] = await timed_sync('persist', finish_turn, turn, answer)
+                outcome = 'ok'
+                _remember_reply(turn, model_name, answer)
+                if turn.needs_summary:
+                    schedule_summary(turn)
+                return answer
+            except BadRequestError as e:
+                if not tried_fallback and is_model_missing(e):
+                    tried_fallback = True
+                    model_name = fallback_model(model_name)
+                    note = MODEL_SWITCH_NOTE.format(model=model_name)
+                    sendChat.append({"role": "system", "content": note})
+                    continue
+                outcome = 'model_error'
+                return f"模型调用失败：{e}. 请确认模型名称已在服务端启用。"
+            except AdmissionTimeout:
+                outcome = 'queue_timeout'
+                return "当前请求较多，请稍后再试。"
+            except Exception as e:  # 广泛捕获防止 500 直接暴露
+                return f"调用出错：{e}"
+    finally:
+        record_turn(turn, outcome)
+
+
+def _load_user(request):
+    """在线程中触发 request.user 的惰性加载（需要查询会话与用户表）。"""
+    user = request.user
+    return user if user.is_authenticated else None
+
+
+def _sse_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # 禁止反向代理缓冲
+    return response
+
+
+async def _single_event(event):
+    yield sse_format(event)
+
+
+async def chat_stream(request):
+    """SSE 流式对话接口：WebSocket 不可用时的回退路径，事件格式与 ChatConsumer 一致。
+
+    全程运行在事件循环上，仅在准备/收尾回合时各有一次数据库线程跳转。
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    user = await sync_to_async(_load_user)(request)
+    if user is None:
+        return JsonResponse({'error': 'unauthorized'}, status=401)
+    message = (request.POST.get('message') or '').strip()
+    if not message:
+        return _sse_response(_single_event({"error": "empty_message"}))
+    turn, wait, elapsed = await timed_sync('db_prepare', prepare_turn, user, message)
+    turn.spans.update(thread_wait=wait, db_prepare=elapsed)
+    if turn.error:
+        record_turn(turn, turn.error)
+        return _sse_response(_single_event(turn_error_event(turn)))
+    return _sse_response(sse_events(turn))
+
+def _render_chatbot(request):
+    user = request.user
+    # 只渲染最近 CHAT_HISTORY_RENDER_TURNS 轮对话，更早的记录由前端滚动时通过历史 API 加载
+    turns = getattr(settings, 'CHAT_HISTORY_RENDER_TURNS', 20)
+    messages, older_cursor = history_page(user, per_page=turns * 2)
+
+    # 将消息按对话分组（用户消息+助手回复）
+    chat_pairs = []
+    user_msg = None
+    for msg in messages:
+        if msg.role == 'user':
+            user_msg = msg
+        elif msg.role == 'assistant' and user_msg:
+            chat_pairs.append({
+                'user_message': user_msg,
+                'assistant_response': msg,
+                'created_at': user_msg.created_at
+            })
+            user_msg = None
+    # 继续加载时从已渲染的最早一轮之前开始，不遗漏被截断的半轮
+    if older_cursor and chat_pairs:
+        older_cursor = encode_cursor(chat_pairs[0]['user_message'])
+
+    # 确保有 UserSetting 以便模板访问 user.usersetting
+    user_setting, _ = UserSetting.objects.get_or_create(user=user)
+    return render(request, 'chatbot.html', {
+        'chat_pairs': chat_pairs,
+        'history_cursor': older_cursor,
+        # 头像 URL 每个请求只计算一次
+        'user_avatar': user_setting.avatar_url or cravatar(user.email, 80),
+    })
+
 
 # Create your views here.
-def chatbot(request):
-    user=request.user
-    if user.id is None:
+@profiled('chatbot')
+async def chatbot(request):
+    """原生异步视图：POST 等待模型时不占用线程池，页面渲染仍在线程中完成。"""
+    user = await sync_to_async(_load_user)(request)
+    if user is None:
         return redirect('login')
-    else:
-        # 使用新的 Message 模型显示聊天历史记录
-        # 获取所有用户消息和助手回复，按时间排序
-        messages = Message.objects.filter(
-            user=request.user, 
-            role__in=['user', 'assistant']
-        ).order_by('created_at')
-        
-        # 将消息按对话分组（用户消息+助手回复）
-        chat_pairs = []
-        user_msg = None
-        for msg in messages:
-            if msg.role == 'user':
-                user_msg = msg
-            elif msg.role == 'assistant' and user_msg:
-                chat_pairs.append({
-                    'user_message': user_msg,
-                    'assistant_response': msg,
-                    'created_at': user_msg.created_at
-                })
-                user_msg = None
-        
-    # 确保有 UserSetting 以便模板访问 user.usersetting
-    UserSetting.objects.get_or_create(user=user)
 
     if request.method == 'POST':
         message = request.POST.get('message')
-        response = ask_openai(message, request)
-        # 由于 ask_openai 已经将消息保存到 Message 表，这里不需要额外保存
+        response = await aask_openai(message, request)
+        # 由于 aask_openai 已经将消息保存到 Message 表，这里不需要额外保存
         return JsonResponse({'message': message, 'response': response})
-    return render(request, 'chatbot.html', {'chat_pairs': chat_pairs})
+    return await sync_to_async(_render_chatbot)(request)
 
 def login(request):
     if request.method == 'POST':
@@ -417,16 +459,10 @@ def logout(request):
     return redirect('login')
 
 @login_required
+@profiled('user_settings')
 def user_settings(request):
     user_setting, _ = UserSetting.objects.get_or_create(user=request.user)
-    
-    # Reset daily count if date has changed
-    if not request.user.is_superuser and not user_setting.user_api_key:
-        today = timezone.now().date()
-        if user_setting.last_message_date != today:
-            user_setting.daily_message_count = 0
-            user_setting.last_message_date = today
-            user_setting.save()
+    # 额度按日期惰性重置，页面通过 messages_used_today 显示当天计数，无需写库
 
     saved = False
     error = None
@@ -447,7 +483,8 @@ def user_settings(request):
             if nickname and len(nickname) <= 150 and nickname != request.user.username:
                 request.user.username = nickname
                 request.user.save(update_fields=['username'])
-            user_setting.save()
+            # 只保存设置字段，避免用旧值覆盖并发回合写入的额度计数
+            user_setting.save(update_fields=SETTINGS_FIELDS)
             saved = True
     return render(request, 'user_settings.html', {
         'user_setting': user_setting,
@@ -474,7 +511,7 @@ def user_settings_update(request):
     user_setting.user_api_key = user_api_key or None
     user_setting.user_base_url = user_base_url or None
     user_setting.avatar_url = avatar_url or None
-    user_setting.save()
+    user_setting.save(update_fields=SETTINGS_FIELDS)
     if nickname and nickname != request.user.username:
         request.user.username = nickname
         request.user.save(update_fields=['username'])
@@ -512,23 +549,33 @@ def inline_change_password(request):
         return JsonResponse({'ok': False, 'error': f'修改失败: {e}'})
 
 @login_required
+@profiled('get_chat_history')
 def get_chat_history(request):
-    """获取用户的聊天历史记录 API"""
-    page = int(request.GET.get('page', 1))
-    per_page = int(request.GET.get('per_page', 50))
+    """获取用户的聊天历史记录 API
+
+    带 ``before`` 或 ``conversation_id`` 参数时使用游标分页（见 ``_chat_history_cursor``），
+    否则保持原有的 page 分页。两种方式的 per_page 均不超过 MAX_PER_PAGE。
+    """
+    if 'before' in request.GET or 'conversation_id' in request.GET:
+        return _chat_history_cursor(request)
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    per_page = clamp_per_page(request.GET.get('per_page'))
     
     # 获取用户的所有对话消息（不包括系统消息和摘要）
-    messages = Message.objects.filter(
-        user=request.user,
-        role__in=['user', 'assistant'],
-        is_summary=False
-    ).select_related('user').order_by('-created_at')
+    messages = history_queryset(request.user).order_by('-created_at')
     
     # 计算分页
     total_messages = messages.count()
     start_index = (page - 1) * per_page
     end_index = start_index + per_page
-    page_messages = messages[start_index:end_index]
+    page_messages = list(messages[start_index:end_index])
+    etag, last_modified = _history_validators(request.user, page_messages, total_messages)
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return not_modified
     
     # 将消息转换为聊天对话格式
     chat_pairs = []
@@ -559,7 +606,7 @@ def get_chat_history(request):
     # 按时间正序排列
     chat_pairs.reverse()
     
-    return JsonResponse({
+    return _with_validators(JsonResponse({
         'success': True,
         'chat_pairs': chat_pairs,
         'pagination': {
@@ -570,32 +617,77 @@ def get_chat_history(request):
             'has_next': end_index < total_messages,
             'has_previous': page > 1
         }
-    })
-
+    }), etag, last_modified)
 
-def generate_summary(user, conversation_id, summary_cmd_local, client, current_send_chat, user_setting):
-    """生成摘要文本。current_send_chat 已含上下文。"""
-    # 添加一条用户指令 summary 到临时消息副本
-    temp = current_send_chat + [{"role": "user", "content": summary_cmd_local}]
-    configured_default = getattr(settings, 'OPENAI_DEFAULT_MODEL', 'gpt-3.5-turbo')
-    model_name = (user_setting.modelName or configured_default).strip()
 
-    def _invoke(model: str):
-        return client.chat.completions.create(model=model, messages=temp)
-
-    tried_fallback = False
-    while True:
-        try:
-            response = _invoke(model_name)
-            return response.choices[0].message.content.strip()
-        except BadRequestError as e:
-            if (not tried_fallback) and ('model' in str(e).lower() and 'exist' in str(e).lower()):
-                tried_fallback = True
-                fallback_model = configured_default
-                if model_name == fallback_model:
-                    fallback_model = 'gpt-3.5-turbo'
-                model_name = fallback_model
-                continue
-            return None
-        except Exception:
-            return None
+def _chat_history_cursor(request):
+    """游标分页：``before`` 为上一页返回的 next_cursor（为空表示从最新开始），
+    ``conversation_id`` 限定会话（``active`` 表示当前会话）。按时间正序返回单条消息，
+    ``include_total=1`` 时才统计总数。
+    """
+    try:
+        before = decode_cursor(request.GET['before']) if request.GET.get('before') else None
+        conversation_id = request.GET.get('conversation_id') or None
+        if conversation_id == 'active':
+            conversation_id = (
+                UserSetting.objects.filter(user=request.user)
+                .values_list('active_conversation_id', flat=True).first()
+            )
+        elif conversation_id is not None:
+            conversation_id = parse_conversation_id(conversation_id)
+    except BadCursor:
+        return JsonResponse({'success': False, 'error': 'bad_cursor'}, status=400)
+    per_page = clamp_per_page(request.GET.get('per_page'))
+    rows, next_cursor = history_page(request.user, before, conversation_id, per_page)
+    total = None
+    if request.GET.get('include_total') == '1':
+        total = history_queryset(request.user, conversation_id).count()
+    etag, last_modified = _history_validators(request.user, rows, total, next_cursor)
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return not_modified
+    data = {
+        'success': True,
+        'messages': [serialize_message(m) for m in rows],
+        'next_cursor': next_cursor,
+        'per_page': per_page,
+    }
+    if total is not None:
+        data['total_messages'] = total
+    return _with_validators(JsonResponse(data), etag, last_modified)
+
+
+def _history_validators(user, rows, *extra):
+    """历史记录页的 ETag 与 Last-Modified。
+
+    消息写入后不再修改，页内最新一条的 id 加上页的首尾与条数即可确定页内容；
+    摘要删除旧消息会改变首尾或条数，ETag 随之变化。
+    """
+    newest = max(rows, key=lambda m: m.pk) if rows else None
+    bounds = (newest.pk, rows[0].pk, rows[-1].pk) if rows else ()
+    key = f'{user.pk}:{bounds}:{len(rows)}:{extra}'
+    digest = hashlib.md5(key.encode('utf-8'), usedforsecurity=False).hexdigest()
+    return quote_etag(digest), newest.created_at.timestamp() if newest else None
+
+
+def _with_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # 浏览器可缓存但每次须用验证器重新确认
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def metrics(request):
+    """Prometheus 抓取接口，须带 ``Authorization: Bearer <METRICS_TOKEN>``。
+
+    未开启或未设置 METRICS_TOKEN 时返回 404。不按来源地址放行：同机反向代理转发的
+    请求在这里都来自本机。"""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if not getattr(settings, 'METRICS_ENABLED', False) or not token:
+        raise Http404()
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not constant_time_compare(supplied, token):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
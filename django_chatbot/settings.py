@@ -1,8 +1,11 @@
 import os
 from pathlib import Path
-from dotenv import load_dotenv
 from typing import Callable, Optional
 
+from dotenv import load_dotenv
+
+from .database import parse_database_url
+
 # 加载 .env （存在则读取）
 load_dotenv()
 
@@ -23,9 +26,17 @@ def _get_env(name: str, default: Optional[str] = None, *, cast: Optional[Callabl
             return default
     return val
 
+
+def _env_bool(name: str, default: bool) -> bool:
+    """读取布尔环境变量：1/true/yes（不区分大小写）为真。"""
+    val = os.getenv(name)
+    if val is None:
+        return default
+    return val.strip().lower() in {'1', 'true', 'yes'}
+
 # 生产环境请在 .env / 外部环境彻底设置 SECRET_KEY
 SECRET_KEY = _get_env('SECRET_KEY', 'dev-insecure-key')
-DEBUG = _get_env('DJANGO_DEBUG', 'False', cast=lambda v: v.lower() in {'1', 'true', 'yes'})
+DEBUG = _env_bool('DJANGO_DEBUG', False)
 _raw_hosts = _get_env('ALLOWED_HOSTS', '127.0.0.1,localhost')
 ALLOWED_HOSTS = [h.strip() for h in _raw_hosts.split(',') if h.strip()]
 
@@ -43,14 +54,64 @@ OPENAI_BASE_URL = _get_env('OPENAI_BASE_URL')  # 例如自建代理或 Azure End
 OPENAI_DEFAULT_MODEL = _get_env('OPENAI_MODEL_DEFAULT', 'gpt-3.5-turbo')
 # 每次构造上下文的近似 token 上限（粗略估算用字符长度换算）
 TOKEN_CONTEXT_LIMIT = int(_get_env('TOKEN_CONTEXT_LIMIT', '3000'))
+# 进程内会话上下文缓存，默认关闭；只适用于单进程部署，多进程时各进程缓存互不同步
+CONTEXT_CACHE_ENABLED = _env_bool('CONTEXT_CACHE_ENABLED', False)
+CONTEXT_CACHE_MAX_CONVERSATIONS = _get_env('CONTEXT_CACHE_MAX_CONVERSATIONS', 1024, cast=int)
+CONTEXT_CACHE_MAX_BYTES = _get_env('CONTEXT_CACHE_MAX_BYTES', 32 * 1024 * 1024, cast=int)
+# WebSocket 流式增量合并：最长攒帧间隔（毫秒，0 表示逐条发送）与字节阈值
+CHAT_STREAM_FLUSH_INTERVAL_MS = _get_env('CHAT_STREAM_FLUSH_INTERVAL_MS', 50, cast=int)
+CHAT_STREAM_FLUSH_BYTES = _get_env('CHAT_STREAM_FLUSH_BYTES', 256, cast=int)
+# 会话摘要在后台线程池中生成（False 时在回复后同步执行，便于测试）
+SUMMARY_ASYNC = _env_bool('SUMMARY_ASYNC', True)
+SUMMARY_MAX_WORKERS = _get_env('SUMMARY_MAX_WORKERS', 2, cast=int)
+# 上游补全准入控制：全局/每用户并发上限，共享 Key 与自带 Key 用户各自的池上限，排队超时秒数
+ADMISSION_GLOBAL_LIMIT = _get_env('ADMISSION_GLOBAL_LIMIT', 32, cast=int)
+ADMISSION_PER_USER_LIMIT = _get_env('ADMISSION_PER_USER_LIMIT', 2, cast=int)
+ADMISSION_SHARED_LIMIT = _get_env('ADMISSION_SHARED_LIMIT', 16, cast=int)
+ADMISSION_OWN_KEY_LIMIT = _get_env('ADMISSION_OWN_KEY_LIMIT', 16, cast=int)
+ADMISSION_QUEUE_TIMEOUT = _get_env('ADMISSION_QUEUE_TIMEOUT', 60, cast=float)
+# /metrics（Prometheus）：默认关闭；开启后还须设置 METRICS_TOKEN，凭 Bearer token 访问
+METRICS_ENABLED = _env_bool('METRICS_ENABLED', False)
+METRICS_TOKEN = _get_env('METRICS_TOKEN', '')
+# 采样 profiler（默认关闭）：按比例随机、指定用户（用户名或 id，逗号分隔）或请求头触发，
+# 请求头的值须与 PROFILING_TOKEN 相同，未设置 token 时不按请求头触发；
+# 结果写入 PROFILING_DIR，最多保留 PROFILING_MAX_FILES 份
+PROFILING_ENABLED = _env_bool('PROFILING_ENABLED', False)
+PROFILING_SAMPLE_RATE = _get_env('PROFILING_SAMPLE_RATE', 0.0, cast=float)
+PROFILING_USERS = _get_env('PROFILING_USERS', '')
+PROFILING_HEADER = _get_env('PROFILING_HEADER', 'X-Profile')
+PROFILING_TOKEN = _get_env('PROFILING_TOKEN', '')
+PROFILING_DIR = _get_env('PROFILING_DIR', str(BASE_DIR / 'profiles'))
+PROFILING_MAX_FILES = _get_env('PROFILING_MAX_FILES', 500, cast=int)
+# 首轮消息回复缓存（默认关闭）：过期秒数、条目上限、每句保留的候选回复数、可缓存的最大输入长度
+RESPONSE_CACHE_ENABLED = _env_bool('RESPONSE_CACHE_ENABLED', False)
+RESPONSE_CACHE_TTL = _get_env('RESPONSE_CACHE_TTL', 3600, cast=float)
+RESPONSE_CACHE_MAX_ENTRIES = _get_env('RESPONSE_CACHE_MAX_ENTRIES', 1024, cast=int)
+RESPONSE_CACHE_VARIANTS = _get_env('RESPONSE_CACHE_VARIANTS', 3, cast=int)
+RESPONSE_CACHE_MAX_INPUT_CHARS = _get_env('RESPONSE_CACHE_MAX_INPUT_CHARS', 32, cast=int)
+# 默认人设改为精简人设 + 按输入从 wiki 检索的前 k 条人物事实（默认关闭）
+WIKI_RETRIEVAL_ENABLED = _env_bool('WIKI_RETRIEVAL_ENABLED', False)
+WIKI_RETRIEVAL_TOP_K = _get_env('WIKI_RETRIEVAL_TOP_K', 4, cast=int)
+WIKI_PATH = _get_env('WIKI_PATH', str(BASE_DIR / 'wiki' / 'takagi-main.json'))
+# 聊天页首屏渲染的最近对话轮数，更早的记录滚动时按需加载
+CHAT_HISTORY_RENDER_TURNS = _get_env('CHAT_HISTORY_RENDER_TURNS', 20, cast=int)
+# 超过该字节数的 JSON 响应才压缩（安装 brotli 时优先 br，否则 gzip）
+JSON_COMPRESSION_MIN_BYTES = _get_env('JSON_COMPRESSION_MIN_BYTES', 1024, cast=int)
+# OpenAI 客户端复用：按 (api_key, base_url) 缓存的客户端数量上限与空闲淘汰秒数
+OPENAI_CLIENT_CACHE_SIZE = _get_env('OPENAI_CLIENT_CACHE_SIZE', 256, cast=int)
+OPENAI_CLIENT_IDLE_TIMEOUT = _get_env('OPENAI_CLIENT_IDLE_TIMEOUT', 600, cast=float)
+# 所有客户端共享的 keep-alive 连接池
+OPENAI_HTTP_MAX_CONNECTIONS = _get_env('OPENAI_HTTP_MAX_CONNECTIONS', 100, cast=int)
+OPENAI_HTTP_MAX_KEEPALIVE = _get_env('OPENAI_HTTP_MAX_KEEPALIVE', 20, cast=int)
+OPENAI_HTTP_KEEPALIVE_EXPIRY = _get_env('OPENAI_HTTP_KEEPALIVE_EXPIRY', 60.0, cast=float)
 # 邮件发送（注册验证码）相关配置（在 .env 中设置）。
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = _get_env('EMAIL_HOST', '')
 EMAIL_PORT = int(_get_env('EMAIL_PORT', '465'))
 EMAIL_HOST_USER = _get_env('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = _get_env('EMAIL_HOST_PASSWORD', '')
-EMAIL_USE_TLS = _get_env('EMAIL_USE_TLS', 'True', cast=lambda v: v.lower() in {'1','true','yes'})
-EMAIL_USE_SSL = _get_env('EMAIL_USE_SSL', 'False', cast=lambda v: v.lower() in {'1','true','yes'})
+EMAIL_USE_TLS = _env_bool('EMAIL_USE_TLS', True)
+EMAIL_USE_SSL = _env_bool('EMAIL_USE_SSL', False)
 DEFAULT_FROM_EMAIL = _get_env('DEFAULT_FROM_EMAIL', EMAIL_HOST_USER or 'no-reply@example.com')
 
 if not EMAIL_HOST or not EMAIL_HOST_USER:
@@ -81,6 +142,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    # 较大的 JSON 响应按 br/gzip 压缩，须位于会修改响应内容的中间件之前
+    'chatbot.middleware.JSONCompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -121,12 +184,55 @@ CHANNEL_LAYERS = {
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite 连接参数：WAL 让流式回合写消息时不阻塞读；busy_timeout 让写锁冲突排队等待而不是立即报错；
+# 写事务用 BEGIN IMMEDIATE 在开始时取得写锁，避免先读后写时锁升级失败（见 chatbot/backends/sqlite3）
+SQLITE_JOURNAL_MODE = _get_env('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = _get_env('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT = _get_env('SQLITE_BUSY_TIMEOUT', 10, cast=float)  # 秒
+SQLITE_MMAP_SIZE = _get_env('SQLITE_MMAP_SIZE', 128 * 1024 * 1024, cast=int)  # 字节
+SQLITE_CACHE_SIZE = _get_env('SQLITE_CACHE_SIZE', -32000, cast=int)  # 负数单位为 KiB
+SQLITE_TEMP_STORE = _get_env('SQLITE_TEMP_STORE', 'MEMORY')
+SQLITE_TRANSACTION_MODE = _get_env('SQLITE_TRANSACTION_MODE', 'IMMEDIATE')
+
+# 数据库：默认项目目录下的 SQLite，也可用 DATABASE_URL 指向 PostgreSQL
+# （需要 pip install .[postgres]）
+DATABASE_URL = _get_env('DATABASE_URL', 'sqlite:///db.sqlite3')
+# 持久连接秒数：Channels 的数据库线程、后台摘要线程与 WSGI 工作线程在此期间复用连接，
+# 0 为每次用完即关闭；ASGI 的 HTTP 请求各用一个临时线程，无法复用（见 chatbot/db_connections.py）
+DATABASE_CONN_MAX_AGE = _get_env('DATABASE_CONN_MAX_AGE', 600, cast=int)
+DATABASE_CONN_HEALTH_CHECKS = _env_bool('DATABASE_CONN_HEALTH_CHECKS', True)
+# PostgreSQL 连接池（psycopg_pool）：开启后连接用完归还池中，CONN_MAX_AGE 固定为 0
+DATABASE_POOL = _env_bool('DATABASE_POOL', False)
+DATABASE_POOL_MIN_SIZE = _get_env('DATABASE_POOL_MIN_SIZE', 2, cast=int)
+DATABASE_POOL_MAX_SIZE = _get_env('DATABASE_POOL_MAX_SIZE', 10, cast=int)
+DATABASE_POOL_TIMEOUT = _get_env('DATABASE_POOL_TIMEOUT', 30, cast=float)
+
+_database = parse_database_url(DATABASE_URL, BASE_DIR)
+if _database['ENGINE'] == 'chatbot.backends.sqlite3':
+    _database['OPTIONS'] = {
+        'timeout': SQLITE_BUSY_TIMEOUT,
+        'transaction_mode': SQLITE_TRANSACTION_MODE,
+        'pragmas': {
+            'journal_mode': SQLITE_JOURNAL_MODE,
+            'synchronous': SQLITE_SYNCHRONOUS,
+            'mmap_size': SQLITE_MMAP_SIZE,
+            'cache_size': SQLITE_CACHE_SIZE,
+            'temp_store': SQLITE_TEMP_STORE,
+        },
+        **_database['OPTIONS'],
     }
-}
+elif DATABASE_POOL:
+    _database['ENGINE'] = 'chatbot.backends.postgresql_pool'
+    _database['OPTIONS']['pool'] = {
+        'min_size': DATABASE_POOL_MIN_SIZE,
+        'max_size': DATABASE_POOL_MAX_SIZE,
+        'timeout': DATABASE_POOL_TIMEOUT,
+    }
+_database['CONN_MAX_AGE'] = (
+    0 if _database['ENGINE'] == 'chatbot.backends.postgresql_pool' else DATABASE_CONN_MAX_AGE
+)
+_database['CONN_HEALTH_CHECKS'] = DATABASE_CONN_HEALTH_CHECKS
+DATABASES = {'default': _database}
 
 
 # Password validation